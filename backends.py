@@ -0,0 +1,227 @@
+"""Concurrency backends for the Socket.IO server.
+
+``Config.ASYNC_MODE`` picks one of:
+
+* ``eventlet`` / ``gevent``: green threads, served by Flask-SocketIO
+* ``threading``: one OS thread per connection, served by Flask-SocketIO
+* ``asgi``: a python-socketio ``AsyncServer`` on an asyncio event loop,
+  served over ASGI (uvicorn) with the Flask pages mounted next to it
+
+The chat handlers are plain functions taking the sid first, registered
+through a transport object, so the same code runs under every mode.
+"""
+import logging
+import sys
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+ASYNC_MODES = ('eventlet', 'gevent', 'threading', 'asgi')
+
+
+def monkey_patch(mode: str) -> None:
+    """Patch the standard library for the green-thread modes.
+
+    Must run before anything else imports socket, ssl or threading.
+    """
+    if mode not in ASYNC_MODES:
+        raise ValueError(f"Unknown ASYNC_MODE {mode!r}, expected one of {', '.join(ASYNC_MODES)}")
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def socket_patched_by() -> Optional[str]:
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('socket'):
+            return 'eventlet'
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('socket'):
+            return 'gevent'
+    return None
+
+
+def native_thread_tools():
+    """``(start_new_thread, allocate_lock, SimpleQueue)`` from the unpatched
+    standard library, for work that must run on a real OS thread."""
+    patched = socket_patched_by()
+    if patched == 'eventlet':
+        from eventlet import patcher
+        thread = patcher.original('_thread')
+        return thread.start_new_thread, thread.allocate_lock, patcher.original('queue').SimpleQueue
+    if patched == 'gevent':
+        from gevent import monkey
+        start_new_thread, allocate_lock = monkey.get_original('_thread', ['start_new_thread', 'allocate_lock'])
+        return start_new_thread, allocate_lock, monkey.get_original('queue', 'SimpleQueue')
+    import _thread
+    import queue
+    return _thread.start_new_thread, _thread.allocate_lock, queue.SimpleQueue
+
+
+def self_check(mode: str, server) -> None:
+    """Fail fast if the server is not running the configured backend."""
+    problems = []
+    if server.async_mode != mode:
+        problems.append(f"server async_mode is {server.async_mode!r}")
+    patched = socket_patched_by()
+    if mode in ('eventlet', 'gevent') and patched != mode:
+        problems.append(f"socket is patched by {patched or 'nobody'}")
+    if mode in ('threading', 'asgi') and patched:
+        problems.append(f"socket is unexpectedly patched by {patched}")
+    if problems:
+        message = f"ASYNC_MODE={mode} is not active: {'; '.join(problems)}"
+        logger.error(message)
+        raise RuntimeError(message)
+    logger.info(f"Concurrency backend active: {mode}")
+
+
+class SyncTransport:
+    """Flask-SocketIO server for the eventlet, gevent and threading modes."""
+
+    def __init__(self, app, mode: str, **options):
+        from flask_socketio import SocketIO
+        self.socketio = SocketIO(app, async_mode=mode, **options)
+        self.server = self.socketio.server
+        self.on_emit: Optional[Callable[[str, Optional[str]], None]] = None
+
+    def on_connect(self, handler: Callable[[str, Optional[str], dict], bool]) -> Callable:
+        """Register ``handler(sid, session_username, auth)`` for new connections."""
+        from flask import request, session
+
+        def connect(*args):
+            return handler(request.sid, session.get('username'), (args[0] if args else None) or {})
+        self.socketio.on_event('connect', connect)
+        return handler
+
+    def on(self, event: str) -> Callable:
+        """Register ``handler(sid, *args)`` for ``event``."""
+        from flask import request
+
+        def decorator(handler):
+            self.socketio.on_event(event, lambda *args: handler(request.sid, *args))
+            return handler
+        return decorator
+
+    def emit(self, event: str, data, to=None, **kwargs) -> None:
+        if self.on_emit is not None:
+            self.on_emit(event, to)
+        self.socketio.emit(event, data, to=to, **kwargs)
+
+    def enter_room(self, sid: str, room: str) -> None:
+        self.server.enter_room(sid, room, namespace='/')
+
+    def room_size(self, room: Optional[str]) -> int:
+        """Local sockets in ``room``; every socket is in room None."""
+        return _room_size(self.server, room)
+
+    def leave_room(self, sid: str, room: str) -> None:
+        self.server.leave_room(sid, room, namespace='/')
+
+    def every(self, interval: float, fn: Callable[[], None]) -> None:
+        def loop():
+            while True:
+                self.socketio.sleep(interval)
+                try:
+                    fn()
+                except Exception:
+                    logger.exception('Periodic task failed')
+        self.socketio.start_background_task(loop)
+
+
+class AsyncTransport:
+    """python-socketio ``AsyncServer`` behind ASGI.
+
+    The handlers stay synchronous and run on the event loop. Everything they
+    send goes through one queue drained by a single task, so emits and room
+    changes reach the server in the order the handlers issued them.
+    """
+
+    def __init__(self, app, **options):
+        import socketio
+        from a2wsgi import WSGIMiddleware
+        self.app = app
+        self.server = socketio.AsyncServer(async_mode='asgi', **options)
+        self.asgi_app = socketio.ASGIApp(self.server, other_asgi_app=WSGIMiddleware(app))
+        self._outbox = None
+        self.on_emit: Optional[Callable[[str, Optional[str]], None]] = None
+
+    def on_connect(self, handler: Callable[[str, Optional[str], dict], bool]) -> Callable:
+        def connect(sid, environ, auth=None):
+            return handler(sid, self._session_username(environ), auth or {})
+        self.server.on('connect', connect)
+        return handler
+
+    def on(self, event: str) -> Callable:
+        def decorator(handler):
+            self.server.on(event, handler)
+            return handler
+        return decorator
+
+    def emit(self, event: str, data, to=None, **kwargs) -> None:
+        if self.on_emit is not None:
+            self.on_emit(event, to)
+        self._submit(self.server.emit, event, data, to=to, **kwargs)
+
+    def enter_room(self, sid: str, room: str) -> None:
+        self._submit(self.server.enter_room, sid, room)
+
+    def room_size(self, room: Optional[str]) -> int:
+        """Local sockets in ``room``; every socket is in room None."""
+        return _room_size(self.server, room)
+
+    def leave_room(self, sid: str, room: str) -> None:
+        self._submit(self.server.leave_room, sid, room)
+
+    def every(self, interval: float, fn: Callable[[], None]) -> None:
+        async def loop():
+            while True:
+                await self.server.sleep(interval)
+                try:
+                    fn()
+                except Exception:
+                    logger.exception('Periodic task failed')
+        self.server.start_background_task(loop)
+
+    def _session_username(self, environ: dict) -> Optional[str]:
+        # No Flask request here, so read the signed session cookie directly
+        from itsdangerous import BadSignature
+        from werkzeug.http import parse_cookie
+        cookie = parse_cookie(environ.get('HTTP_COOKIE', '')).get(
+            self.app.config['SESSION_COOKIE_NAME'])
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        if not cookie or serializer is None:
+            return None
+        try:
+            return serializer.loads(cookie).get('username')
+        except BadSignature:
+            return None
+
+    def _submit(self, fn: Callable, *args, **kwargs) -> None:
+        if self._outbox is None:
+            import asyncio
+            self._outbox = asyncio.Queue()
+            self.server.start_background_task(self._drain)
+        self._outbox.put_nowait((fn, args, kwargs))
+
+    async def _drain(self) -> None:
+        while True:
+            fn, args, kwargs = await self._outbox.get()
+            try:
+                await fn(*args, **kwargs)
+            except Exception:
+                logger.exception('Outbound socket operation failed')
+
+
+def _room_size(server, room: Optional[str]) -> int:
+    return len(server.manager.rooms.get('/', {}).get(room, ()))
+
+
+def create_transport(app, mode: str, **options):
+    if mode == 'asgi':
+        return AsyncTransport(app, **options)
+    return SyncTransport(app, mode, **options)
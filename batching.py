@@ -0,0 +1,40 @@
+import threading
+from typing import Callable, Dict, List
+
+
+class MessageBatcher:
+    """Collects outbound room messages and sends them as one frame per room.
+
+    Messages are queued per room and flushed every ``window`` seconds, or as
+    soon as a room has ``max_size`` pending, by calling ``send(room, batch)``
+    once. The Socket.IO manager encodes each emit once and reuses the packet
+    for every member of the room, so a batch costs one encode per wire format
+    regardless of how many messages or recipients it has. A room's batch is
+    taken and sent under one lock, so batches go out in the order their
+    messages were added; callers must serialize ``add`` per room in message
+    order (``main.post_message`` holds a per-room lock around numbering and
+    queueing).
+    """
+
+    def __init__(self, send: Callable[[str, List[dict]], None], window: float, max_size: int):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[dict]] = {}
+
+    def add(self, room: str, message: dict) -> None:
+        with self._lock:
+            batch = self._pending.setdefault(room, [])
+            batch.append(message)
+            if len(batch) >= self.max_size:
+                del self._pending[room]
+                self.send(room, batch)
+
+    def flush(self) -> int:
+        """Send every pending batch; returns the number of frames sent."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            for room, batch in pending.items():
+                self.send(room, batch)
+            return len(pending)
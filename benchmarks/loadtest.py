@@ -0,0 +1,416 @@
+"""Load test for the chat server.
+
+Starts the app under gunicorn (same config as production, so the backend is
+picked by ASYNC_MODE and several workers bring up the hub), connects N
+simulated users with ``socketio.AsyncClient`` spread over
+``Config.CHAT_ROOMS`` and drives room chat, private messages, join/leave
+churn and reconnect storms for a fixed time. Reports end-to-end delivery
+latency (p50/p99), throughput and the server's RSS and CPU, and writes
+everything as JSON so backends and commits can be compared.
+
+    python benchmarks/loadtest.py --users 200 --duration 30 --async-mode eventlet
+    python benchmarks/loadtest.py --users 500 --workers 4 --env MESSAGE_BATCH_MS=20
+    python benchmarks/loadtest.py --url http://localhost:5000   # running server
+
+All users run on one event loop in this process, so the report includes the
+harness's own CPU time: when it approaches the run time, the client is the
+bottleneck, not the server. Needs aiohttp for the asyncio websocket client.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+
+import msgpack
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from config import Config  # noqa: E402
+
+TAG = 'bench:'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+def summarize(latencies):
+    if not latencies:
+        return {'count': 0, 'p50': None, 'p99': None, 'max': None}
+    return {
+        'count': len(latencies),
+        'p50': round(percentile(latencies, 50), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'max': round(max(latencies), 3),
+    }
+
+
+class ServerProcess:
+    """The app under gunicorn, plus CPU and RSS of its process tree from /proc."""
+
+    def __init__(self, port, async_mode, workers, env, log_path):
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        server_env = dict(os.environ, PORT=str(port), ASYNC_MODE=async_mode, WEB_CONCURRENCY=str(workers))
+        server_env.update(env)
+        self._log = open(log_path, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+            cwd=ROOT, env=server_env, stdout=self._log, stderr=subprocess.STDOUT
+        )
+
+    def wait_ready(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited with status {self.process.returncode}')
+            try:
+                with urllib.request.urlopen(self.url + '/health', timeout=1) as response:
+                    if response.status == 200:
+                        return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('Server did not become ready')
+
+    def pids(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                stat = _read_stat(entry)
+                if stat is not None:
+                    children.setdefault(int(stat[1]), []).append(int(entry))
+        pids, pending = [], [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, ()))
+        return pids
+
+    def sample(self):
+        """(CPU seconds, RSS bytes) summed over the server's processes."""
+        cpu = rss = 0
+        for pid in self.pids():
+            stat = _read_stat(str(pid))
+            if stat is None:
+                continue
+            # Fields after the command name: utime and stime are 14 and 15,
+            # rss is 24 (1-based, counting from the pid)
+            cpu += (int(stat[11]) + int(stat[12])) / CLOCK_TICKS
+            rss += int(stat[21]) * PAGE_SIZE
+        return cpu, rss
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._log.close()
+
+
+def _read_stat(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, so split after its closing paren
+    return data[data.rindex(')') + 2:].split()
+
+
+class Stats:
+    def __init__(self):
+        self.sent_at = {}
+        self.sent = {'room': 0, 'private': 0, 'churn': 0}
+        self.delivered = {'room': 0, 'private': 0}
+        self.latency = {'room': [], 'private': []}
+        self.errors = 0
+        self.storms = []
+        self.recording = False
+
+    def token(self, kind):
+        token = f'{TAG}{kind}:{len(self.sent_at)}'
+        self.sent_at[token] = time.monotonic()
+        if self.recording:
+            self.sent[kind] += 1
+        return token
+
+    def received(self, kind, text):
+        sent_at = self.sent_at.get(text)
+        if sent_at is None or not self.recording:
+            return
+        self.delivered[kind] += 1
+        self.latency[kind].append((time.monotonic() - sent_at) * 1000)
+
+
+class SimUser:
+    def __init__(self, index, stats, args, rooms):
+        self.name = f'bench{index}'
+        self.stats = stats
+        self.args = args
+        self.room = rooms[index % len(rooms)]
+        self.compact = random.random() < args.compact_share
+        self.connected = False
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.client.on('message', self.on_message)
+        self.client.on('messages', self.on_messages)
+        self.client.on('private_message', self.on_private)
+        self.client.on('c', self.on_compact)
+
+    async def on_message(self, data):
+        self.stats.received('room', data['msg'])
+
+    async def on_messages(self, batch):
+        for data in batch['messages']:
+            self.stats.received('room', data['msg'])
+
+    async def on_private(self, data):
+        self.stats.received('private', data['msg'])
+
+    async def on_compact(self, data):
+        frame = msgpack.unpackb(data)
+        if frame[0] == 2:
+            for row in frame[3]:
+                self.stats.received('room', row[3])
+        elif frame[0] == 3:
+            self.stats.received('private', frame[4])
+
+    async def connect(self):
+        await self.client.connect(
+            self.args.url, transports=['websocket'], wait_timeout=30,
+            auth={'proto': 'compact' if self.compact else 'json'}
+        )
+        await self.client.emit('set_username', self.name)
+        if self.room != 'General':
+            await self.client.emit('join', {'room': self.room})
+            await self.client.emit('leave', {'room': 'General'})
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+        await self.client.disconnect()
+
+    async def act(self, users, rooms):
+        kind = random.choices(
+            ('room', 'private', 'churn'),
+            (self.args.message_rate, self.args.private_rate, self.args.churn_rate)
+        )[0]
+        if kind == 'room':
+            await self.client.emit('message', {'room': self.room, 'msg': self.stats.token('room')})
+        elif kind == 'private':
+            target = random.choice(users)
+            await self.client.emit('message', {
+                'type': 'private', 'target': target.name, 'msg': self.stats.token('private')
+            })
+        else:
+            room = random.choice(rooms)
+            await self.client.emit('leave', {'room': self.room})
+            await self.client.emit('join', {'room': room})
+            self.room = room
+            if self.stats.recording:
+                self.stats.sent['churn'] += 1
+
+    async def run(self, users, rooms, until):
+        rate = self.args.message_rate + self.args.private_rate + self.args.churn_rate
+        if rate <= 0:
+            return
+        while True:
+            delay = random.expovariate(rate)
+            if time.monotonic() + delay >= until:
+                return
+            await asyncio.sleep(delay)
+            if not self.connected:
+                continue
+            try:
+                await self.act(users, rooms)
+            except Exception:
+                self.stats.errors += 1
+
+
+async def connect_all(users, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def connect(user):
+        nonlocal failed
+        async with limit:
+            try:
+                await user.connect()
+            except Exception:
+                failed += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*(connect(user) for user in users))
+    return {'seconds': time.monotonic() - start, 'failed': failed}
+
+
+async def storms(users, stats, args, until):
+    """Drop a share of the users at once and reconnect them all together."""
+    while time.monotonic() + args.storm_interval < until:
+        await asyncio.sleep(args.storm_interval)
+        victims = random.sample([u for u in users if u.connected],
+                                int(len(users) * args.storm_fraction))
+        await asyncio.gather(*(user.disconnect() for user in victims), return_exceptions=True)
+        result = await connect_all(victims, args.connect_concurrency)
+        stats.storms.append({'users': len(victims), **result})
+
+
+async def run(args, server):
+    rooms = list(Config.CHAT_ROOMS)
+    stats = Stats()
+    users = [SimUser(i, stats, args, rooms) for i in range(args.users)]
+    connected = await connect_all(users, args.connect_concurrency)
+    await asyncio.sleep(args.warmup)
+
+    start = time.monotonic()
+    until = start + args.duration
+    server_before = server.sample() if server else None
+    client_before = os.times()
+    rss_peak = 0
+    stats.recording = True
+
+    async def sample_rss():
+        nonlocal rss_peak
+        while time.monotonic() < until:
+            rss_peak = max(rss_peak, server.sample()[1])
+            await asyncio.sleep(0.5)
+
+    tasks = [user.run(users, rooms, until) for user in users]
+    if args.storm_interval > 0 and args.storm_fraction > 0:
+        tasks.append(storms(users, stats, args, until))
+    if server:
+        tasks.append(sample_rss())
+    await asyncio.gather(*tasks)
+    # Let in-flight messages arrive before the counters stop
+    await asyncio.sleep(args.drain)
+    stats.recording = False
+    elapsed = time.monotonic() - start
+
+    server_after = server.sample() if server else None
+    client_after = os.times()
+    await asyncio.gather(*(user.disconnect() for user in users if user.connected),
+                         return_exceptions=True)
+
+    sent = sum(stats.sent[kind] for kind in ('room', 'private'))
+    delivered = sum(stats.delivered.values())
+    result = {
+        'connect': {'users': args.users, **connected},
+        'elapsed_seconds': elapsed,
+        'sent': stats.sent,
+        'delivered': stats.delivered,
+        'errors': stats.errors,
+        'throughput': {
+            'sent_per_second': sent / elapsed,
+            'delivered_per_second': delivered / elapsed,
+            'room_fanout': stats.delivered['room'] / stats.sent['room'] if stats.sent['room'] else None,
+        },
+        'latency_ms': {kind: summarize(values) for kind, values in stats.latency.items()},
+        'reconnect_storms': stats.storms,
+        'client_cpu_seconds': (client_after.user + client_after.system)
+                              - (client_before.user + client_before.system),
+    }
+    if server:
+        cpu = server_after[0] - server_before[0]
+        result['server'] = {
+            'cpu_seconds': cpu,
+            'cpu_percent': 100 * cpu / elapsed,
+            'rss_peak_mb': max(rss_peak, server_after[1]) / 2 ** 20,
+            'rss_end_mb': server_after[1] / 2 ** 20,
+        }
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of measured traffic')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds to wait after connecting')
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for in-flight messages')
+    parser.add_argument('--message-rate', type=float, default=0.5, help='room messages per user per second')
+    parser.add_argument('--private-rate', type=float, default=0.05, help='private messages per user per second')
+    parser.add_argument('--churn-rate', type=float, default=0.02, help='room switches per user per second')
+    parser.add_argument('--storm-interval', type=float, default=0, help='seconds between reconnect storms (0: none)')
+    parser.add_argument('--storm-fraction', type=float, default=0.25, help='share of users dropped per storm')
+    parser.add_argument('--compact-share', type=float, default=0, help='share of users on the compact protocol')
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--async-mode', default=os.environ.get('ASYNC_MODE', 'eventlet'))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra server environment, e.g. MESSAGE_BATCH_MS=20')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the per-connection rate limits on (they throttle the simulated users)')
+    parser.add_argument('--url', help='benchmark a running server instead of starting one')
+    parser.add_argument('--server-log', default=os.devnull)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON result path (default benchmarks/results/<commit>-<mode>-<time>.json)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    env = dict(item.split('=', 1) for item in args.env)
+    if not args.rate_limits:
+        env.setdefault('RATE_LIMITING', 'False')
+
+    server = None
+    if args.url is None:
+        server = ServerProcess(args.port, args.async_mode, args.workers, env, args.server_log)
+        args.url = server.url
+    try:
+        if server:
+            server.wait_ready()
+        result = asyncio.run(run(args, server))
+    finally:
+        if server:
+            server.stop()
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'server_env': env,
+        **result,
+    }
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results',
+        f"{commit or 'unknown'}-{args.async_mode}-{datetime.now():%Y%m%d%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    latency = result['latency_ms']
+    print(f"{args.users} users, {args.async_mode} x{args.workers}: "
+          f"{result['throughput']['sent_per_second']:.1f} sent/s, "
+          f"{result['throughput']['delivered_per_second']:.1f} delivered/s, "
+          f"room p50/p99 {latency['room']['p50']}/{latency['room']['p99']} ms")
+    if 'server' in result:
+        print(f"server CPU {result['server']['cpu_percent']:.0f}%, "
+              f"peak RSS {result['server']['rss_peak_mb']:.1f} MB; "
+              f"client CPU {result['client_cpu_seconds']:.1f}s")
+    print(f"Saved {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import os
+
+# App Configuration Settings
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
+    DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
+    CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*')
+    CHAT_ROOMS = ['General', 'Introductions', 'off-topics', 'Hobbies and sports']
+    # Concurrency backend: eventlet, gevent, threading or asgi (see backends.py)
+    ASYNC_MODE = os.environ.get('ASYNC_MODE', 'eventlet').lower()
+    # 'delta' sends coalesced per-room join/leave deltas, 'full' broadcasts the
+    # whole user list on every connect/disconnect
+    PRESENCE_MODE = os.environ.get('PRESENCE_MODE', 'delta').lower()
+    PRESENCE_COALESCE_MS = int(os.environ.get('PRESENCE_COALESCE_MS', '250'))
+    # Server-side room history, capped per room
+    HISTORY_MAX_MESSAGES = int(os.environ.get('HISTORY_MAX_MESSAGES', '500'))
+    HISTORY_MAX_BYTES = int(os.environ.get('HISTORY_MAX_BYTES', str(256 * 1024)))
+    HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '50'))
+    # Batch outbound room messages for up to this many ms (0 disables
+    # batching) or until a room has MESSAGE_BATCH_MAX pending
+    MESSAGE_BATCH_MS = int(os.environ.get('MESSAGE_BATCH_MS', '0'))
+    MESSAGE_BATCH_MAX = int(os.environ.get('MESSAGE_BATCH_MAX', '50'))
+    # Token buckets per Socket.IO event as (events per second, burst), applied
+    # to every sid and to every username; events not listed are unlimited
+    RATE_LIMITING = os.environ.get('RATE_LIMITING', 'True').lower() in ('true', '1', 't')
+    RATE_LIMITS = {
+        'message': (5, 10),
+        'join': (2, 5),
+        'leave': (2, 5),
+        'set_username': (0.2, 3),
+        'presence_sync': (1, 5),
+        'history': (2, 10),
+        'resume': (2, 5),
+    }
+    # Seconds between sweeps that forget buckets which have refilled
+    RATE_LIMIT_SWEEP_SECONDS = float(os.environ.get('RATE_LIMIT_SWEEP_SECONDS', '60'))
+    # Packets queued for one connection before it counts as a slow consumer
+    # (0 disables the cap); 'drop' discards further messages, 'disconnect'
+    # closes it so the client reconnects and resumes from history
+    OUTBOUND_QUEUE_MAX = int(os.environ.get('OUTBOUND_QUEUE_MAX', '1000'))
+    OUTBOUND_POLICY = os.environ.get('OUTBOUND_POLICY', 'disconnect').lower()
+    # Fraction of the per-message log lines to keep (1.0 logs all of them)
+    LOG_MESSAGE_SAMPLE_RATE = float(os.environ.get('LOG_MESSAGE_SAMPLE_RATE', '1.0'))
+    # Unix socket of the fan-out hub; set by gunicorn.conf.py when running
+    # more than one worker
+    HUB_SOCKET = os.environ.get('HUB_SOCKET')
+    # History epoch shared by the hub and every worker, also set by
+    # gunicorn.conf.py; a single process picks its own at startup
+    HUB_EPOCH = os.environ.get('HUB_EPOCH')
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# Gunicorn settings; the worker count comes from WEB_CONCURRENCY (default 1)
+# and the worker type from ASYNC_MODE, matching the backend main.py selects
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
+_async_mode = os.environ.get('ASYNC_MODE', 'eventlet').lower()
+worker_class = {
+    'eventlet': 'eventlet',
+    'gevent': 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker',
+    'threading': 'gthread',
+    'asgi': 'uvicorn.workers.UvicornWorker',
+}[_async_mode]
+wsgi_app = 'main:asgi_app' if _async_mode == 'asgi' else 'main:app'
+if _async_mode == 'threading':
+    threads = int(os.environ.get('GUNICORN_THREADS', '100'))
+
+# Seconds to wait before restarting a hub that exited
+_HUB_RESTART_DELAY = 0.5
+
+_hub_process = None
+_stopping = threading.Event()
+
+
+def on_starting(server):
+    """Start the fan-out hub before the workers when running more than one.
+
+    Workers find the hub through HUB_SOCKET, which they inherit from the
+    master together with HUB_EPOCH, the history epoch that the hub and all
+    workers share so that history cursors are valid on every worker. See hub.py for why clients must use the websocket transport once
+    there is more than one worker. A thread in the master restarts the hub
+    whenever it exits; the workers reconnect and re-announce their sockets.
+    """
+    if server.cfg.workers < 2:
+        return
+    path = os.environ.setdefault(
+        'HUB_SOCKET', os.path.join(tempfile.gettempdir(), f'chat-hub-{os.getpid()}.sock')
+    )
+    epoch = os.environ.setdefault('HUB_EPOCH', uuid.uuid4().hex[:8])
+    # Imported only now so Config picks up HUB_SOCKET in the forked workers
+    from config import Config
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hub.py'),
+        path, str(Config.HISTORY_MAX_MESSAGES), str(Config.HISTORY_MAX_BYTES), epoch
+    ]
+    _start_hub(server, command)
+    threading.Thread(target=_supervise_hub, args=(server, command), daemon=True).start()
+
+
+def _start_hub(server, command):
+    global _hub_process
+    _hub_process = subprocess.Popen(command)
+    server.log.info(f"Started hub (pid {_hub_process.pid}) on {command[2]}")
+
+
+def _supervise_hub(server, command):
+    while True:
+        status = _hub_process.wait()
+        if _stopping.is_set():
+            return
+        server.log.error(f"Hub exited with status {status}, restarting")
+        time.sleep(_HUB_RESTART_DELAY)
+        if _stopping.is_set():
+            return
+        _start_hub(server, command)
+
+
+def on_exit(server):
+    _stopping.set()
+    if _hub_process is not None and _hub_process.poll() is None:
+        _hub_process.terminate()
@@ -0,0 +1,124 @@
+import threading
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Rough per-message bookkeeping cost on top of the text fields
+MESSAGE_OVERHEAD_BYTES = 64
+
+
+def message_size(message: dict) -> int:
+    return MESSAGE_OVERHEAD_BYTES + sum(
+        len(value.encode('utf-8')) for value in message.values() if isinstance(value, str)
+    )
+
+
+class _RoomBuffer:
+    def __init__(self):
+        self.messages: Deque[dict] = deque()
+        self.sizes: Deque[int] = deque()
+        self.bytes = 0
+        self.last_seq = 0
+
+    @property
+    def first_seq(self) -> int:
+        return self.messages[0]['seq'] if self.messages else self.last_seq + 1
+
+
+class RoomHistory:
+    """Per-room ring buffer of recent chat messages.
+
+    Every appended message gets the next sequence id of its room. Sequence
+    ids are contiguous, so a cursor maps straight to a position in the
+    buffer. Old messages are evicted once a room exceeds ``max_messages`` or
+    ``max_bytes``. ``epoch`` changes whenever the process restarts, so
+    clients can tell that their cursors belong to a previous buffer.
+    Processes that share one replicated history are given the same
+    ``epoch``.
+    """
+
+    def __init__(self, max_messages: int, max_bytes: int, epoch: Optional[str] = None):
+        self.epoch = epoch or uuid.uuid4().hex[:8]
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._rooms: Dict[str, _RoomBuffer] = {}
+
+    def append(self, room: str, message: dict) -> dict:
+        """Stamp ``message`` with the next sequence id and store it."""
+        with self._lock:
+            buf = self._rooms.setdefault(room, _RoomBuffer())
+            buf.last_seq += 1
+            message['seq'] = buf.last_seq
+            size = message_size(message)
+            buf.messages.append(message)
+            buf.sizes.append(size)
+            buf.bytes += size
+            self._evict(buf)
+            return message
+
+    def page(self, room: str, before: Optional[int] = None,
+             limit: int = 50) -> Tuple[List[dict], bool]:
+        """Return up to ``limit`` messages older than ``before``, oldest first,
+        and whether even older ones are still retained."""
+        with self._lock:
+            buf = self._rooms.get(room)
+            if buf is None or not buf.messages:
+                return [], False
+            first = buf.first_seq
+            end = len(buf.messages) if before is None else max(0, min(before - first, len(buf.messages)))
+            start = max(0, end - limit)
+            return list(islice(buf.messages, start, end)), start > 0
+
+    def since(self, room: str, last_seq: int) -> Tuple[List[dict], bool]:
+        """Return messages newer than ``last_seq`` and whether some of the
+        messages in between were already evicted."""
+        with self._lock:
+            buf = self._rooms.get(room)
+            if buf is None:
+                return [], last_seq > 0
+            first = buf.first_seq
+            if last_seq > buf.last_seq:
+                return [], True
+            start = max(0, last_seq + 1 - first)
+            return list(islice(buf.messages, start, None)), last_seq + 1 < first
+
+    def export(self) -> dict:
+        with self._lock:
+            return {
+                'rooms': {
+                    room: {'last_seq': buf.last_seq, 'messages': list(buf.messages)}
+                    for room, buf in self._rooms.items()
+                }
+            }
+
+    def load(self, state: dict) -> None:
+        """Adopt the rooms of an exported state that are ahead of ours."""
+        with self._lock:
+            for room, exported in state['rooms'].items():
+                current = self._rooms.get(room)
+                if current is not None and current.last_seq >= exported['last_seq']:
+                    continue
+                buf = _RoomBuffer()
+                for message in exported['messages']:
+                    size = message_size(message)
+                    buf.messages.append(message)
+                    buf.sizes.append(size)
+                    buf.bytes += size
+                self._evict(buf)
+                buf.last_seq = exported['last_seq']
+                self._rooms[room] = buf
+
+    def stats(self, room: str) -> dict:
+        with self._lock:
+            buf = self._rooms.get(room)
+            if buf is None:
+                return {'messages': 0, 'bytes': 0, 'last_seq': 0}
+            return {'messages': len(buf.messages), 'bytes': buf.bytes, 'last_seq': buf.last_seq}
+
+    def _evict(self, buf: _RoomBuffer) -> None:
+        while buf.messages and (len(buf.messages) > self.max_messages
+                                or buf.bytes > self.max_bytes):
+            buf.messages.popleft()
+            buf.bytes -= buf.sizes.popleft()
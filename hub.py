@@ -0,0 +1,442 @@
+"""Broker-free fan-out hub for running the chat server on several workers.
+
+One hub process listens on a local Unix socket and every worker connects to
+it through ``HubManager``, a python-socketio ``PubSubManager`` backend. Each
+frame a worker publishes is relayed, in arrival order, to every connected
+worker (the sender included), so ``emit(..., room=...)`` reaches clients on
+any worker without Redis or another external broker.
+
+Alongside the Socket.IO traffic the workers replicate their presence and
+history changes as ``replicate`` frames. The hub applies them to its own
+copy of the state and hands a snapshot to every worker that (re)connects.
+Chat messages are only appended once they come back from the hub, so all
+processes assign the same sequence ids. When a worker goes away the hub
+tells the others to forget its sockets.
+
+Sticky sessions: the hub does not move a client's socket between workers,
+so every engine.io connection must stay on the worker that accepted it.
+A websocket is a single TCP connection and always does. Long-polling sends
+several HTTP requests per session, and gunicorn's workers share one
+listening socket, so nothing can route those requests back to the same
+worker. Long-polling is therefore unsupported with more than one worker:
+the server then accepts only the websocket transport, and clients must
+connect with ``transports: ['websocket']`` (as the bundled pages do).
+"""
+import asyncio
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+from typing import Callable, Dict, Iterator, Optional
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+from history import RoomHistory
+from presence import PresenceRegistry
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+# Reconnect backoff; the hub is local and is restarted right away when it dies
+_RETRY_MIN = 0.5
+_RETRY_MAX = 5
+
+
+def send_frame(sock: socket.socket, payload: bytes) -> None:
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def iter_frames(sock: socket.socket) -> Iterator[bytes]:
+    """Yield length-prefixed frames from ``sock`` until it is closed."""
+    buffer = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return
+        buffer += chunk
+        while len(buffer) >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(buffer)
+            if len(buffer) < _HEADER.size + length:
+                break
+            yield buffer[_HEADER.size:_HEADER.size + length]
+            buffer = buffer[_HEADER.size + length:]
+
+
+class ClusterState:
+    """Applies replicated presence and history operations.
+
+    Used by the workers and by the hub, so every process holds the same
+    view of who is online and of the recent room history. ``host_id`` is
+    the worker's own id (None in the hub).
+    """
+
+    def __init__(self, presence: PresenceRegistry, history: RoomHistory,
+                 host_id: Optional[str] = None):
+        self.presence = presence
+        self.history = history
+        self.host_id = host_id
+        self.owners: Dict[str, str] = {}  # sid -> host_id of its worker
+
+    def apply(self, op: dict) -> Optional[dict]:
+        """Apply ``op``; returns the stored message for ``chat`` operations."""
+        kind = op['op']
+        if kind == 'add':
+            self.presence.add(op['sid'], op['username'], op.get('protocol', 'json'))
+            self.owners[op['sid']] = op['host_id']
+        elif kind == 'remove':
+            self.presence.remove(op['sid'])
+            self.owners.pop(op['sid'], None)
+        elif kind == 'join':
+            self.presence.join(op['sid'], op['room'])
+        elif kind == 'leave':
+            self.presence.leave(op['sid'], op['room'])
+        elif kind == 'rename':
+            self.presence.rename(op['sid'], op['username'])
+        elif kind == 'chat':
+            return self.history.append(op['room'], op['message'])
+        elif kind in ('announce', 'snapshot'):
+            self.merge(op)
+        elif kind == 'purge':
+            self.purge(op['host_id'])
+        return None
+
+    def merge(self, state: dict) -> None:
+        """Apply an ``announce`` or ``snapshot``.
+
+        Changes published while the hub was down are lost, so neither is
+        merged into what we know: an announce lists every socket of its
+        worker and replaces them, and a snapshot lists every socket the hub
+        knows and replaces those of the other workers.
+        """
+        if state['op'] == 'announce':
+            self.purge(state['host_id'])
+        else:
+            listed = {entry[0] for entry in state['sids']}
+            for sid, owner in list(self.owners.items()):
+                if owner != self.host_id and sid not in listed:
+                    self.presence.remove(sid)
+                    del self.owners[sid]
+        for sid, username, rooms, host_id, protocol in state['sids']:
+            if sid in self.presence:
+                continue
+            self.presence.add(sid, username, protocol)
+            self.owners[sid] = host_id
+            for room in rooms:
+                self.presence.join(sid, room)
+        self.history.load(state['history'])
+
+    def purge(self, host_id: str) -> None:
+        for sid in [sid for sid, owner in self.owners.items() if owner == host_id]:
+            self.presence.remove(sid)
+            del self.owners[sid]
+
+    def export(self, op: str, host_id: Optional[str] = None) -> dict:
+        """Dump the state (only ``host_id``'s sockets, if given) as ``op``."""
+        sids = []
+        for sid, owner in list(self.owners.items()):
+            user = self.presence.user(sid)
+            if user is None or (host_id is not None and owner != host_id):
+                continue
+            sids.append([sid, user['username'], sorted(user['rooms']), owner, user['protocol']])
+        return {'method': 'replicate', 'op': op, 'host_id': host_id,
+                'sids': sids, 'history': self.history.export()}
+
+
+class HubServer:
+    """Single-threaded relay; its event loop gives all frames one order."""
+
+    def __init__(self, path: str, state: ClusterState):
+        self.path = path
+        self.state = state
+        self._selector = selectors.DefaultSelector()
+        self._clients: Dict[socket.socket, dict] = {}
+
+    def serve_forever(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(128)
+        listener.setblocking(False)
+        self._selector.register(listener, selectors.EVENT_READ)
+        logger.info(f"Hub listening on {self.path}")
+        while True:
+            for key, events in self._selector.select():
+                if key.fileobj is listener:
+                    self._accept(listener)
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._read(key.fileobj)
+                if events & selectors.EVENT_WRITE and key.fileobj in self._clients:
+                    self._write(key.fileobj)
+
+    def _accept(self, listener: socket.socket) -> None:
+        conn, _ = listener.accept()
+        conn.setblocking(False)
+        self._clients[conn] = {'inbuf': b'', 'outbuf': b'', 'host_id': None}
+        self._selector.register(conn, selectors.EVENT_READ)
+        self._queue(conn, self._encode(self.state.export('snapshot')))
+
+    def _read(self, conn: socket.socket) -> None:
+        try:
+            chunk = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self._drop(conn)
+            return
+        client = self._clients[conn]
+        buffer = client['inbuf'] + chunk
+        while len(buffer) >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(buffer)
+            if len(buffer) < _HEADER.size + length:
+                break
+            frame = buffer[_HEADER.size:_HEADER.size + length]
+            buffer = buffer[_HEADER.size + length:]
+            self._relay(conn, frame)
+        client['inbuf'] = buffer
+
+    def _relay(self, conn: socket.socket, frame: bytes) -> None:
+        data = json.loads(frame)
+        if data.get('method') == 'replicate':
+            self._clients[conn]['host_id'] = data['host_id']
+            self.state.apply(data)
+        packet = _HEADER.pack(len(frame)) + frame
+        for other in list(self._clients):
+            self._queue(other, packet)
+
+    def _queue(self, conn: socket.socket, packet: bytes) -> None:
+        client = self._clients[conn]
+        if not client['outbuf']:
+            self._selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        client['outbuf'] += packet
+
+    def _write(self, conn: socket.socket) -> None:
+        client = self._clients[conn]
+        try:
+            sent = conn.send(client['outbuf'])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._drop(conn)
+            return
+        client['outbuf'] = client['outbuf'][sent:]
+        if not client['outbuf']:
+            self._selector.modify(conn, selectors.EVENT_READ)
+
+    def _drop(self, conn: socket.socket) -> None:
+        client = self._clients.pop(conn)
+        self._selector.unregister(conn)
+        conn.close()
+        if client['host_id'] is None:
+            return
+        logger.info(f"Worker {client['host_id']} left the hub")
+        purge = {'method': 'replicate', 'op': 'purge', 'host_id': client['host_id']}
+        self.state.apply(purge)
+        for other in list(self._clients):
+            self._queue(other, self._encode(purge))
+
+    @staticmethod
+    def _encode(data: dict) -> bytes:
+        payload = json.dumps(data).encode('utf-8')
+        return _HEADER.pack(len(payload)) + payload
+
+
+def run_hub(path: str, history_max_messages: int, history_max_bytes: int, epoch: str) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    state = ClusterState(PresenceRegistry(), RoomHistory(history_max_messages, history_max_bytes, epoch))
+    HubServer(path, state).serve_forever()
+
+
+class HubManager(socketio.PubSubManager):
+    """python-socketio client manager that talks to a ``HubServer``.
+
+    ``replicate`` frames never reach the Socket.IO layer; they are passed to
+    ``on_replicate`` instead. ``on_connect`` returns a frame that is sent
+    first on every (re)connection, so a restarted hub learns about the
+    sockets this worker already holds. ``replicate`` calls ``on_failure``
+    when the frame cannot be handed to the hub.
+    """
+    name = 'hub'
+
+    def __init__(self, path: str, channel: str = 'socketio', write_only: bool = False,
+                 logger=None, on_replicate: Optional[Callable[[dict], None]] = None,
+                 on_connect: Optional[Callable[[], Optional[dict]]] = None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.on_replicate = on_replicate
+        self.on_connect = on_connect
+        self._sock: Optional[socket.socket] = None
+        self._send_lock = threading.Lock()
+
+    def replicate(self, data: dict, on_failure: Optional[Callable[[], None]] = None) -> None:
+        """Send a ``replicate`` frame to the hub and the other workers."""
+        if not self._publish(data) and on_failure is not None:
+            on_failure()
+
+    def _connect(self) -> socket.socket:
+        # Caller holds _send_lock
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self._sock = sock
+        greeting = self.on_connect() if self.on_connect else None
+        if greeting:
+            send_frame(sock, self.json.dumps(greeting).encode('utf-8'))
+        return sock
+
+    def _disconnect(self, sock: socket.socket) -> None:
+        with self._send_lock:
+            if self._sock is sock:
+                self._sock = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _publish(self, data: dict) -> bool:
+        payload = self.json.dumps(data).encode('utf-8')
+        for attempt in range(2):
+            with self._send_lock:
+                try:
+                    sock = self._sock or self._connect()
+                    send_frame(sock, payload)
+                    return True
+                except OSError as e:
+                    error = e
+                    if self._sock is not None:
+                        self._sock.close()
+                        self._sock = None
+        self._get_logger().error(f"Hub publish failed: {error}")
+        return False
+
+    def _listen(self) -> Iterator[dict]:
+        retry_sleep = _RETRY_MIN
+        while True:
+            try:
+                with self._send_lock:
+                    sock = self._sock or self._connect()
+            except OSError as e:
+                self._get_logger().error(f"Cannot reach hub at {self.path}: {e}, "
+                                         f"retrying in {retry_sleep}s")
+                self.server.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, _RETRY_MAX)
+                continue
+            retry_sleep = _RETRY_MIN
+            try:
+                for frame in iter_frames(sock):
+                    data = self.json.loads(frame)
+                    if data.get('method') == 'replicate':
+                        if self.on_replicate:
+                            try:
+                                self.on_replicate(data)
+                            except Exception:
+                                self._get_logger().exception('Replication handler error')
+                        continue
+                    yield data
+            except OSError as e:
+                self._get_logger().error(f"Hub connection lost: {e}")
+            self._disconnect(sock)
+
+
+
+class AsyncHubManager(AsyncPubSubManager):
+    """asyncio counterpart of ``HubManager`` for the ASGI backend."""
+    name = 'hub'
+
+    def __init__(self, path: str, channel: str = 'socketio', write_only: bool = False,
+                 logger=None, on_replicate: Optional[Callable[[dict], None]] = None,
+                 on_connect: Optional[Callable[[], Optional[dict]]] = None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.on_replicate = on_replicate
+        self.on_connect = on_connect
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def replicate(self, data: dict, on_failure: Optional[Callable[[], None]] = None) -> None:
+        """Queue a ``replicate`` frame; callable from synchronous handlers."""
+        async def publish():
+            if not await self._publish(data) and on_failure is not None:
+                on_failure()
+        asyncio.ensure_future(publish())
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _connect(self) -> asyncio.StreamReader:
+        # Caller holds the lock
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        greeting = self.on_connect() if self.on_connect else None
+        if greeting:
+            payload = self.json.dumps(greeting).encode('utf-8')
+            self._writer.write(_HEADER.pack(len(payload)) + payload)
+            await self._writer.drain()
+        return self._reader
+
+    def _close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _publish(self, data: dict) -> bool:
+        payload = self.json.dumps(data).encode('utf-8')
+        async with self._get_lock():
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    self._writer.write(_HEADER.pack(len(payload)) + payload)
+                    await self._writer.drain()
+                    return True
+                except OSError as e:
+                    error = e
+                    self._close()
+        self._get_logger().error(f"Hub publish failed: {error}")
+        return False
+
+    async def _listen(self):
+        retry_sleep = _RETRY_MIN
+        while True:
+            try:
+                async with self._get_lock():
+                    reader = self._reader or await self._connect()
+            except OSError as e:
+                self._get_logger().error(f"Cannot reach hub at {self.path}: {e}, "
+                                         f"retrying in {retry_sleep}s")
+                await asyncio.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, _RETRY_MAX)
+                continue
+            retry_sleep = _RETRY_MIN
+            try:
+                while True:
+                    (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                    data = self.json.loads(await reader.readexactly(length))
+                    if data.get('method') == 'replicate':
+                        if self.on_replicate:
+                            try:
+                                self.on_replicate(data)
+                            except Exception:
+                                self._get_logger().exception('Replication handler error')
+                        continue
+                    yield data
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self._get_logger().error(f"Hub connection lost: {e!r}")
+            if self._reader is reader:
+                self._close()
+
+
+if __name__ == '__main__':
+    import sys
+    run_hub(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
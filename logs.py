@@ -0,0 +1,66 @@
+"""Non-blocking logging.
+
+Log calls only put the record on a queue, and a listener on a real OS thread
+formats it and writes it out. Under eventlet and gevent the listener uses the
+unpatched thread primitives, so a slow stderr never blocks the hub that
+delivers messages.
+"""
+import atexit
+import logging
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+import backends
+
+
+class SampleFilter(logging.Filter):
+    """Passes roughly ``rate`` of the records (0.0 to 1.0)."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues the record untouched; formatting happens on the listener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class NativeQueueListener(QueueListener):
+    """``QueueListener`` whose thread is never a green thread."""
+
+    def start(self) -> None:
+        start_new_thread, allocate_lock, _ = backends.native_thread_tools()
+        self._done = allocate_lock()
+        self._done.acquire()
+
+        def run():
+            try:
+                self._monitor()
+            finally:
+                self._done.release()
+        start_new_thread(run, ())
+
+    def stop(self) -> None:
+        self.enqueue_sentinel()
+        self._done.acquire(timeout=5)
+
+
+def configure(level: int, fmt: str) -> QueueListener:
+    """Send the root logger's records through a queue to a stderr handler."""
+    _, _, simple_queue = backends.native_thread_tools()
+    log_queue = simple_queue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = NativeQueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
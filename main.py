@@ -1,44 +1,265 @@
+from config import Config
+import backends
+# Green-thread modes must patch the standard library before anything else
+backends.monkey_patch(Config.ASYNC_MODE)
 import os
 import random
 import logging
+import threading
+import time
 from datetime import datetime
-from typing import Dict
-import eventlet
+from functools import partial, wraps
 from flask import Flask, render_template, request, session
-from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.middleware.proxy_fix import ProxyFix
-eventlet.monkey_patch()
-# Config logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from batching import MessageBatcher
+from history import RoomHistory
+import logs
+from metrics import Metrics
+from hub import AsyncHubManager, ClusterState, HubManager
+from presence import PresenceBroadcaster, PresenceRegistry
+from protocol import PROTOCOLS, CompactCodec, WireRooms, wire_room
+from ratelimit import OutboundLimiter, RateLimiter
+# Config logging; records are written from a background thread
+logs.configure(logging.INFO, '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-
-# App Configuration Settings
-class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
-    DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
-    CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*')
-    CHAT_ROOMS = ['General', 'Introductions', 'off-topics', 'Hobbies and sports']
+# Per-message lines, optionally sampled
+message_logger = logger.getChild('messages')
+message_logger.addFilter(logs.SampleFilter(Config.LOG_MESSAGE_SAMPLE_RATE))
 
 # Initialize Flask app
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.config.from_object(Config)
+
+# In-memory user tracking, indexed by sid, username and room
+presence = PresenceRegistry()
+
+# Recent messages per room for paging and reconnect replay
+history = RoomHistory(app.config['HISTORY_MAX_MESSAGES'], app.config['HISTORY_MAX_BYTES'],
+                      app.config['HUB_EPOCH'])
 
-# Initialize SocketIO with proper configuration for production
-socketio = SocketIO(
+# With several workers, presence and history changes are replicated
+# through the hub so every worker holds the same state
+client_manager = None
+if app.config['HUB_SOCKET']:
+    manager_class = AsyncHubManager if app.config['ASYNC_MODE'] == 'asgi' else HubManager
+    client_manager = manager_class(
+        app.config['HUB_SOCKET'],
+        on_replicate=lambda op: on_replicate(op),
+        on_connect=lambda: cluster.export('announce', client_manager.host_id)
+    )
+host_id = client_manager.host_id if client_manager else 'local'
+cluster = ClusterState(presence, history, host_id)
+
+# Initialize the Socket.IO server for the configured concurrency backend
+transport = backends.create_transport(
     app,
+    app.config['ASYNC_MODE'],
     cors_allowed_origins=app.config['CORS_ORIGINS'],
     logger=False,  # Disable SocketIO logging in production
     engineio_logger=False,
-    async_mode='threading',  # Use threading for better compatibility
     ping_timeout=60,
-    ping_interval=25
+    ping_interval=25,
+    # Long-polling sends several requests per session and gunicorn may hand
+    # them to different workers, so a cluster only accepts websockets
+    transports=['websocket'] if client_manager else None,
+    client_manager=client_manager
 )
+backends.self_check(app.config['ASYNC_MODE'], transport.server)
+# Flask-SocketIO object (green-thread and threading modes) or ASGI app
+socketio = getattr(transport, 'socketio', None)
+asgi_app = getattr(transport, 'asgi_app', None)
+
+# Flood protection: inbound token buckets and a cap on queued outbound packets
+rate_limiter = RateLimiter(app.config['RATE_LIMITS']) if app.config['RATE_LIMITING'] else None
+outbound_limiter = None
+if app.config['OUTBOUND_QUEUE_MAX'] > 0:
+    outbound_limiter = OutboundLimiter(app.config['OUTBOUND_QUEUE_MAX'], app.config['OUTBOUND_POLICY'])
+    outbound_limiter.install(transport.server.eio)
+
+def reply(sid: str, event: str, data) -> None:
+    """Emit to a socket of this worker, which needs no trip through the hub."""
+    transport.emit(event, data, to=sid, ignore_queue=True)
+
+def limited(event: str):
+    """Skip calls of ``event`` over the rate limit of the sid or its username."""
+    def decorator(handler):
+        if rate_limiter is None or event not in rate_limiter.limits:
+            return handler
+
+        @wraps(handler)
+        def wrapper(sid: str, *args):
+            username = presence.username(sid)
+            wait = rate_limiter.check(event, sid, username and f'user:{username}')
+            if wait is None:
+                return handler(sid, *args)
+            # Tell the client once per run of rejections, not once per event
+            if rate_limiter.first_rejection(event, sid):
+                reply(sid, 'rate_limited', {'event': event, 'retry_after': round(wait, 2)})
+                logger.warning(f"Rate limited {event} from {username}")
+        return wrapper
+    return decorator
+
+metrics = Metrics()
+metrics.collect('chat_connected_sockets', 'gauge', 'Socket.IO connections on this worker',
+                lambda: [((), transport.room_size(None))])
+metrics.collect('chat_users_online', 'gauge', 'Distinct usernames online on all workers',
+                lambda: [((), len(presence.usernames()))])
+metrics.collect('chat_room_users', 'gauge', 'Usernames present in each room',
+                lambda: [((('room', room),), len(presence.room_users(room)))
+                         for room in app.config['CHAT_ROOMS']])
+metrics.collect('chat_history_messages', 'gauge', 'Messages retained in each room history',
+                lambda: [((('room', room),), history.stats(room)['messages'])
+                         for room in app.config['CHAT_ROOMS']])
+metrics.collect('chat_history_bytes', 'gauge', 'Estimated bytes retained in each room history',
+                lambda: [((('room', room),), history.stats(room)['bytes'])
+                         for room in app.config['CHAT_ROOMS']])
+metrics.counter('chat_messages_total', 'Room messages posted through this worker')
+metrics.rate('chat_room_messages_per_second', 'Room messages per second over the last minute')
+metrics.counter('chat_private_messages_total', 'Private messages sent through this worker')
+metrics.counter('chat_emits_total', 'Socket.IO emits by event')
+metrics.counter('chat_emit_recipients_total', 'Sockets on this worker addressed by emits, by event')
+metrics.histogram('chat_handler_seconds', 'Socket.IO event handler latency')
+if rate_limiter is not None:
+    metrics.collect('chat_rate_limited_total', 'counter', 'Events rejected by the rate limiter',
+                    lambda: [((('event', event),), count) for event, count in rate_limiter.rejected.items()])
+if outbound_limiter is not None:
+    metrics.collect('chat_outbound_dropped_total', 'counter', 'Packets dropped for slow connections',
+                    lambda: [((), outbound_limiter.dropped)])
+    metrics.collect('chat_outbound_disconnected_total', 'counter', 'Slow connections closed',
+                    lambda: [((), outbound_limiter.disconnected)])
+
+def record_emit(event: str, to) -> None:
+    labels = (('event', event),)
+    metrics.inc('chat_emits_total', labels=labels)
+    metrics.inc('chat_emit_recipients_total', transport.room_size(to), labels=labels)
+
+transport.on_emit = record_emit
+
+def timed(event: str):
+    """Record the run time of ``event`` handlers in the latency histogram."""
+    labels = (('event', event),)
+
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(sid: str, *args):
+            start = time.perf_counter()
+            try:
+                return handler(sid, *args)
+            finally:
+                metrics.observe('chat_handler_seconds', time.perf_counter() - start, labels)
+        return wrapper
+    return decorator
+
+def on(event: str):
+    """Register a Socket.IO event handler, timed and rate limited."""
+    def decorator(handler):
+        return transport.on(event)(timed(event)(limited(event)(handler)))
+    return decorator
+
+presence_broadcaster = None
+if app.config['PRESENCE_MODE'] == 'delta':
+    # Every worker sees all presence changes, so deltas only go to local clients
+    presence_broadcaster = PresenceBroadcaster(
+        presence, partial(transport.emit, ignore_queue=True),
+        app.config['PRESENCE_COALESCE_MS'] / 1000.0
+    )
+
+def replicate(op: str, **fields) -> None:
+    data = {'method': 'replicate', 'op': op, 'host_id': host_id, **fields}
+    cluster.apply(data)
+    if client_manager is not None:
+        client_manager.replicate(data)
+
+# Clients negotiate JSON or the compact msgpack protocol when connecting;
+# room messages go out once per protocol that has local listeners
+codec = CompactCodec(app.config['CHAT_ROOMS'])
+wire = WireRooms()
+
+def send_messages(room: str, messages: list) -> None:
+    # Delivery happens on every worker from the replicated history, so
+    # messages only go to local clients
+    if wire.has_members(room, 'json'):
+        if message_batcher is None:
+            transport.emit('message', messages[0], to=wire_room(room, 'json'), ignore_queue=True)
+        else:
+            transport.emit('messages', {'room': room, 'messages': messages},
+                           to=wire_room(room, 'json'), ignore_queue=True)
+    if wire.has_members(room, 'compact'):
+        transport.emit('c', codec.messages(room, messages),
+                       to=wire_room(room, 'compact'), ignore_queue=True)
+
+message_batcher = None
+if app.config['MESSAGE_BATCH_MS'] > 0:
+    message_batcher = MessageBatcher(
+        send_messages,
+        app.config['MESSAGE_BATCH_MS'] / 1000.0,
+        app.config['MESSAGE_BATCH_MAX']
+    )
+
+# Numbering a message and queueing it for delivery happen under one lock per
+# room, so two handlers posting at once cannot queue seq 6 ahead of seq 5
+_room_locks = {room: threading.Lock() for room in app.config['CHAT_ROOMS']}
+
+def deliver_message(room: str, message: dict) -> None:
+    if message_batcher is not None:
+        message_batcher.add(room, message)
+    else:
+        send_messages(room, [message])
+
+def enter_room(sid: str, room: str) -> None:
+    transport.enter_room(sid, room)
+    transport.enter_room(sid, wire.join(sid, room))
+
+def post_message(sid: str, room: str, message: dict) -> None:
+    if client_manager is None:
+        with _room_locks[room]:
+            deliver_message(room, history.append(room, message))
+        return
+
+    def failed():
+        # The hub is down (the gunicorn master restarts it), so nobody got the
+        # message; tell the sender instead of dropping it silently
+        logger.error(f"Message in {room} by {message['username']} not delivered: hub unreachable")
+        reply(sid, 'message_failed', {
+            'room': room,
+            'msg': message['msg'],
+            'reason': 'unavailable'
+        })
+    # Sequence ids are assigned when the hub hands the message back, so all
+    # workers number it the same way
+    client_manager.replicate({
+        'method': 'replicate', 'op': 'chat', 'host_id': host_id,
+        'room': room, 'message': message
+    }, on_failure=failed)
+
+def on_replicate(op: dict) -> None:
+    if op['op'] == 'chat':
+        # Runs on the single hub listener, which applies frames in hub order
+        deliver_message(op['room'], cluster.apply(op))
+    elif op.get('host_id') != host_id:
+        cluster.apply(op)
+
+_background_lock = threading.Lock()
+_background_started = False
 
-# In-memory user tracking
-active_users: Dict[str, dict] = {}
+def start_background_tasks() -> None:
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    if presence_broadcaster is not None:
+        transport.every(presence_broadcaster.interval, presence_broadcaster.flush)
+    if message_batcher is not None:
+        transport.every(message_batcher.window, message_batcher.flush)
+    if rate_limiter is not None:
+        transport.every(app.config['RATE_LIMIT_SWEEP_SECONDS'], rate_limiter.sweep)
+
+def broadcast_active_users() -> None:
+    if presence_broadcaster is None:
+        transport.emit('active_users', {
+            'users': presence.usernames()
+        })
 
 def generate_guest_username() -> str:
     timestamp = datetime.now().strftime('%H%M')
@@ -59,93 +280,150 @@ def set_name():
     logger.info(f"User chose name: {chosen}")
     return '', 204
 
-@socketio.event
-def connect():
+@transport.on_connect
+@timed('connect')
+def connect(sid: str, username: str, auth: dict):
     try:
-        if 'username' not in session:
-            session['username'] = generate_guest_username()
+        username = username or generate_guest_username()
+        protocol = auth.get('proto') if isinstance(auth, dict) else None
+        if protocol not in PROTOCOLS:
+            protocol = 'json'
         
-        active_users[request.sid] = {
-            'username': session['username'],
-            'connected_at': datetime.now().isoformat(),
-            'room': 'General'
-        }
+        start_background_tasks()
+        if protocol == 'compact':
+            reply(sid, 'c', codec.hello())
+        replicate('add', sid=sid, username=username, protocol=protocol)
+        wire.add(sid, protocol)
         
-        join_room('General')
+        enter_room(sid, 'General')
+        replicate('join', sid=sid, room='General')
+        broadcast_active_users()
         
-        emit('active_users', {
-            'users': [user['username'] for user in active_users.values()]
-        }, broadcast=True)
-        
-        logger.info(f"User connected: {session['username']}")
+        logger.info(f"User connected: {username}")
         return True
     except Exception as e:
         logger.error(f"Connection error: {str(e)}")
+        # A rejected connection gets no disconnect event, so undo the
+        # registration here or the sid stays in presence for good
+        wire.remove(sid)
+        if presence.user(sid) is not None:
+            replicate('remove', sid=sid)
         return False
 
-@socketio.event
-def disconnect():
+@on('disconnect')
+def disconnect(sid: str, *args):
     try:
-        if request.sid in active_users:
-            username = active_users[request.sid]['username']
-            del active_users[request.sid]
-            
-            emit('active_users', {
-                'users': [user['username'] for user in active_users.values()]
-            }, broadcast=True)
+        wire.remove(sid)
+        username = presence.username(sid)
+        if rate_limiter is not None:
+            rate_limiter.forget(sid)
+            rate_limiter.forget(f'user:{username}', only_full=True)
+        if username is not None:
+            replicate('remove', sid=sid)
+            broadcast_active_users()
             
             logger.info(f"User disconnected: {username}")
     except Exception as e:
         logger.error(f"Disconnection error: {str(e)}")
 
-@socketio.on('join')
-def on_join(data: dict):
+@on('join')
+def on_join(sid: str, data: dict):
     try:
-        username = session['username']
+        username = presence.username(sid)
         room = data['room']
         
         if room not in app.config['CHAT_ROOMS']:
             logger.warning(f"Invalid room join attempt: {room}")
             return
         
-        join_room(room)
-        active_users[request.sid]['room'] = room
+        enter_room(sid, room)
+        replicate('join', sid=sid, room=room)
+        if presence_broadcaster is not None:
+            reply(sid, 'presence_snapshot', presence_broadcaster.snapshot(room))
         
-        emit('status', {
+        transport.emit('status', {
             'msg': f'{username} has joined the room.',
             'type': 'join',
             'timestamp': datetime.now().isoformat()
-        }, room=room)
+        }, to=room)
         
         logger.info(f"User {username} joined room: {room}")
     except Exception as e:
         logger.error(f"Join room error: {str(e)}")
 
-@socketio.on('leave')
-def on_leave(data: dict):
+@on('leave')
+def on_leave(sid: str, data: dict):
     try:
-        username = session['username']
+        username = presence.username(sid)
         room = data['room']
         
-        leave_room(room)
+        transport.leave_room(sid, room)
+        transport.leave_room(sid, wire.leave(sid, room))
+        replicate('leave', sid=sid, room=room)
         
-        if request.sid in active_users:
-            active_users[request.sid].pop('room', None)
-        
-        emit('status', {
+        transport.emit('status', {
             'msg': f'{username} has left the room.',
             'type': 'leave',
             'timestamp': datetime.now().isoformat()
-        }, room=room)
+        }, to=room)
         
         logger.info(f"User {username} left room: {room}")
     except Exception as e:
         logger.error(f"Leave room error: {str(e)}")
 
-@socketio.on('message')
-def handle_message(data: dict):
+@on('presence_sync')
+def on_presence_sync(sid: str, data: dict):
+    try:
+        room = data['room']
+        if presence_broadcaster is None or room not in app.config['CHAT_ROOMS']:
+            return
+        reply(sid, 'presence_snapshot', presence_broadcaster.snapshot(room))
+    except Exception as e:
+        logger.error(f"Presence sync error: {str(e)}")
+
+@on('history')
+def on_history(sid: str, data: dict):
+    try:
+        room = data['room']
+        if room not in app.config['CHAT_ROOMS']:
+            return
+        limit = min(int(data.get('limit') or app.config['HISTORY_PAGE_SIZE']),
+                    app.config['HISTORY_PAGE_SIZE'])
+        before = data.get('before')
+        messages, has_more = history.page(room, int(before) if before else None, limit)
+        reply(sid, 'history', {
+            'room': room,
+            'epoch': history.epoch,
+            'messages': messages,
+            'has_more': has_more
+        })
+    except Exception as e:
+        logger.error(f"History error: {str(e)}")
+
+@on('resume')
+def on_resume(sid: str, data: dict):
+    try:
+        room = data['room']
+        if room not in app.config['CHAT_ROOMS']:
+            return
+        # Cursors from another epoch point into a buffer that no longer exists
+        if data.get('epoch') != history.epoch:
+            messages, truncated = [], True
+        else:
+            messages, truncated = history.since(room, int(data.get('last_seq') or 0))
+        reply(sid, 'resume', {
+            'room': room,
+            'epoch': history.epoch,
+            'messages': messages,
+            'truncated': truncated
+        })
+    except Exception as e:
+        logger.error(f"Resume error: {str(e)}")
+
+@on('message')
+def handle_message(sid: str, data: dict):
     try:
-        username = session['username']
+        username = presence.username(sid)
         room = data.get('room', 'General')
         msg_type = data.get('type', 'message')
         message = data.get('msg', '').strip()
@@ -160,41 +438,58 @@ def handle_message(data: dict):
             if not target_user:
                 return
             
-            # Find target user and send private message
-            for sid, user_data in active_users.items():
-                if user_data['username'] == target_user:
-                    emit('private_message', {
-                        'msg': message,
-                        'from': username,
-                        'to': target_user,
-                        'timestamp': timestamp
-                    }, room=sid)
-                    logger.info(f"Private message sent: {username} -> {target_user}")
-                    return
+            # Deliver to every open tab of the target user
+            target_sids = presence.sids_for(target_user)
+            if not target_sids:
+                logger.warning(f"Private message failed - user not found: {target_user}")
+                return
             
-            logger.warning(f"Private message failed - user not found: {target_user}")
+            payload = {
+                'msg': message,
+                'from': username,
+                'to': target_user,
+                'timestamp': timestamp
+            }
+            compact = None
+            for target_sid in target_sids:
+                target = presence.user(target_sid)
+                if target is not None and target['protocol'] == 'compact':
+                    compact = compact or codec.private(payload)
+                    transport.emit('c', compact, to=target_sid)
+                else:
+                    transport.emit('private_message', payload, to=target_sid)
+            metrics.inc('chat_private_messages_total')
+            message_logger.info(f"Private message sent: {username} -> {target_user}")
         else:
             if room not in app.config['CHAT_ROOMS']:
                 logger.warning(f"Message to invalid room: {room}")
                 return
             
-            emit('message', {
+            post_message(sid, room, {
                 'msg': message,
                 'username': username,
                 'room': room,
                 'timestamp': timestamp
-            }, room=room)
+            })
             
-            logger.info(f"Message sent in {room} by {username}")
+            metrics.inc('chat_messages_total', labels=(('room', room),), rate='chat_room_messages_per_second')
+            message_logger.info(f"Message sent in {room} by {username}")
     except Exception as e:
         logger.error(f"Message handling error: {str(e)}")
 
-@socketio.on('set_username')
-def set_username(username):
+@on('set_username')
+def set_username(sid: str, username: str):
     try:
-        session['username'] = username
-        if request.sid in active_users:
-            active_users[request.sid]['username'] = username
+        if not isinstance(username, str) or not username.strip():
+            logger.warning(f"Invalid username from {sid}: {username!r}")
+            return
+        username = username.strip()
+        old = presence.username(sid)
+        replicate('rename', sid=sid, username=username)
+        # Guest names are random per connection, so a name nobody uses any
+        # more is not coming back
+        if rate_limiter is not None and old not in (None, username) and not presence.sids_for(old):
+            rate_limiter.forget(f'user:{old}')
         logger.info(f"Username set: {username}")
     except Exception as e:
         logger.error(f"Set username error: {str(e)}")
@@ -202,18 +497,32 @@ def set_username(username):
 # Health check endpoint for Render
 @app.route('/health')
 def health_check():
-    return {'status': 'healthy', 'timestamp': datetime.now().isoformat()}
+    return {
+        'status': 'healthy',
+        'async_mode': app.config['ASYNC_MODE'],
+        'rate_limit': rate_limiter.stats() if rate_limiter else None,
+        'outbound': outbound_limiter.stats() if outbound_limiter else None,
+        'timestamp': datetime.now().isoformat()
+    }
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 # Run server
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug_mode = app.config['DEBUG']
     
-    socketio.run(
-        app,
-        host='0.0.0.0',
-        port=port,
-        debug=debug_mode,
-        use_reloader=debug_mode,
-        log_output=True
-    )
\ No newline at end of file
+    if asgi_app is not None:
+        import uvicorn
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port)
+    else:
+        socketio.run(
+            app,
+            host='0.0.0.0',
+            port=port,
+            debug=debug_mode,
+            use_reloader=debug_mode,
+            log_output=True
+        )
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Counters and histograms are updated on the hot path, so each update is a
+dict lookup and an addition under one lock. Everything else is read from
+callbacks when ``/metrics`` is scraped. With several workers every worker
+reports its own numbers; Prometheus sums them.
+"""
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{{{pairs}}}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RateMeter:
+    """Events per second over the last ``window`` seconds, one slot per second."""
+
+    def __init__(self, window: int = 60):
+        self.window = window
+        self._slots = [0] * window
+        self._seconds = [0] * window
+
+    def add(self, now: float, count: int = 1) -> None:
+        second = int(now)
+        slot = second % self.window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._slots[slot] = 0
+        self._slots[slot] += count
+
+    def rate(self, now: float) -> float:
+        oldest = int(now) - self.window
+        total = sum(n for n, second in zip(self._slots, self._seconds) if second > oldest)
+        return total / self.window
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Registry of named metrics; ``render`` returns the ``/metrics`` body."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._rates: Dict[str, Dict[Labels, RateMeter]] = {}
+        self._collectors: Dict[str, Callable[[], Iterable[Tuple[Labels, float]]]] = {}
+
+    def counter(self, name: str, help: str) -> None:
+        self._help[name] = ('counter', help)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self._help[name] = ('histogram', help)
+        self._histograms[name] = {}
+        self._buckets[name] = buckets
+
+    def rate(self, name: str, help: str) -> None:
+        """A gauge of events per second, fed through ``inc`` of ``counter``."""
+        self._help[name] = ('gauge', help)
+        self._rates[name] = {}
+
+    def collect(self, name: str, kind: str, help: str,
+                collect: Callable[[], Iterable[Tuple[Labels, float]]]) -> None:
+        """A metric of type ``kind`` whose samples ``collect`` returns at scrape time."""
+        self._help[name] = (kind, help)
+        self._collectors[name] = collect
+
+    def inc(self, name: str, value: float = 1, labels: Labels = (), rate: Optional[str] = None) -> None:
+        with self._lock:
+            series = self._counters[name]
+            series[labels] = series.get(labels, 0) + value
+            if rate is not None:
+                meters = self._rates[rate]
+                meter = meters.get(labels)
+                if meter is None:
+                    meter = meters[labels] = RateMeter()
+                meter.add(time.time(), value)
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        with self._lock:
+            series = self._histograms[name]
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(self._buckets[name])
+            histogram.observe(value)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        now = time.time()
+        for name, (kind, help) in self._help.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if name in self._collectors:
+                for labels, value in self._collectors[name]():
+                    lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            with self._lock:
+                if name in self._counters:
+                    for labels, value in self._counters[name].items():
+                        lines.append(f'{name}{_labels(labels)} {value}')
+                elif name in self._rates:
+                    for labels, meter in self._rates[name].items():
+                        lines.append(f'{name}{_labels(labels)} {meter.rate(now)}')
+                else:
+                    for labels, histogram in self._histograms[name].items():
+                        lines.extend(self._render_histogram(name, labels, histogram))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histogram(name: str, labels: Labels, histogram: Histogram) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+        lines.append(f'{name}_sum{_labels(labels)} {histogram.total}')
+        lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+        return lines
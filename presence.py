@@ -0,0 +1,197 @@
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set
+
+
+class PresenceRegistry:
+    """Indexed view of who is connected and where.
+
+    Keeps three indexes in sync so that the socket handlers never have to
+    scan every connection:
+
+    * ``sid -> user``: username, connect time and joined rooms per socket
+    * ``username -> sids``: all sockets (tabs) a username has open
+    * ``room -> {username: socket count}``: who is present in each room
+
+    A username counts as present in a room while at least one of its sockets
+    is in that room, so several tabs show up as a single user. ``on_change``
+    is called as ``on_change(room, username, joined)`` whenever that flips.
+    """
+
+    def __init__(self, on_change: Optional[Callable[[str, str, bool], None]] = None):
+        self.on_change = on_change
+        self._lock = threading.RLock()
+        self._sids: Dict[str, dict] = {}
+        self._by_username: Dict[str, Set[str]] = {}
+        self._rooms: Dict[str, Dict[str, int]] = {}
+
+    def add(self, sid: str, username: str, protocol: str = 'json') -> None:
+        with self._lock:
+            if sid in self._sids:
+                self.remove(sid)
+            self._sids[sid] = {
+                'username': username,
+                'protocol': protocol,
+                'connected_at': datetime.now().isoformat(),
+                'rooms': set()
+            }
+            self._by_username.setdefault(username, set()).add(sid)
+
+    def remove(self, sid: str) -> Optional[dict]:
+        with self._lock:
+            user = self._sids.get(sid)
+            if user is None:
+                return None
+            for room in list(user['rooms']):
+                self.leave(sid, room)
+            del self._sids[sid]
+            self._discard_sid(user['username'], sid)
+            return user
+
+    def join(self, sid: str, room: str) -> bool:
+        """Put ``sid`` in ``room``; True if its username was not there yet."""
+        with self._lock:
+            user = self._sids.get(sid)
+            if user is None or room in user['rooms']:
+                return False
+            user['rooms'].add(room)
+            members = self._rooms.setdefault(room, {})
+            count = members.get(user['username'], 0)
+            members[user['username']] = count + 1
+            if count:
+                return False
+            if self.on_change:
+                self.on_change(room, user['username'], True)
+            return True
+
+    def leave(self, sid: str, room: str) -> bool:
+        """Take ``sid`` out of ``room``; True if its username is now gone."""
+        with self._lock:
+            user = self._sids.get(sid)
+            if user is None or room not in user['rooms']:
+                return False
+            user['rooms'].discard(room)
+            members = self._rooms[room]
+            count = members[user['username']] - 1
+            if count:
+                members[user['username']] = count
+                return False
+            del members[user['username']]
+            if not members:
+                del self._rooms[room]
+            if self.on_change:
+                self.on_change(room, user['username'], False)
+            return True
+
+    def rename(self, sid: str, username: str) -> Optional[str]:
+        """Change the username behind ``sid``, returning the old one."""
+        # Checked before touching any index, so a bad name changes nothing
+        if not isinstance(username, str) or not username:
+            raise ValueError(f"Invalid username: {username!r}")
+        with self._lock:
+            user = self._sids.get(sid)
+            if user is None or user['username'] == username:
+                return None
+            rooms = list(user['rooms'])
+            for room in rooms:
+                self.leave(sid, room)
+            old = user['username']
+            self._discard_sid(old, sid)
+            user['username'] = username
+            self._by_username.setdefault(username, set()).add(sid)
+            for room in rooms:
+                self.join(sid, room)
+            return old
+
+    def user(self, sid: str) -> Optional[dict]:
+        return self._sids.get(sid)
+
+    def username(self, sid: str) -> Optional[str]:
+        user = self._sids.get(sid)
+        return user['username'] if user else None
+
+    def sids_for(self, username: str) -> List[str]:
+        with self._lock:
+            return list(self._by_username.get(username, ()))
+
+    def room_users(self, room: str) -> List[str]:
+        with self._lock:
+            return list(self._rooms.get(room, {}))
+
+    def usernames(self) -> List[str]:
+        with self._lock:
+            return list(self._by_username)
+
+    def __len__(self) -> int:
+        return len(self._sids)
+
+    def __contains__(self, sid: str) -> bool:
+        return sid in self._sids
+
+    def _discard_sid(self, username: str, sid: str) -> None:
+        sids = self._by_username.get(username)
+        if sids is None:
+            return
+        sids.discard(sid)
+        if not sids:
+            del self._by_username[username]
+
+
+class PresenceBroadcaster:
+    """Coalesces per-room presence changes into versioned deltas.
+
+    Join/leave transitions are buffered per room and flushed every
+    ``interval`` seconds as a single ``presence`` event carrying the users
+    that joined and left since the previous flush. A user who joins and
+    leaves within the same window cancels out and is never sent. Each flush
+    bumps the room version; a client that sees a gap asks for a snapshot.
+    """
+
+    def __init__(self, registry: PresenceRegistry, emit: Callable, interval: float):
+        self.registry = registry
+        self.emit = emit
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, int]] = {}
+        self._versions: Dict[str, int] = {}
+        registry.on_change = self.record
+
+    def record(self, room: str, username: str, joined: bool) -> None:
+        with self._lock:
+            changes = self._pending.setdefault(room, {})
+            net = changes.get(username, 0) + (1 if joined else -1)
+            if net:
+                changes[username] = net
+            else:
+                changes.pop(username, None)
+
+    def snapshot(self, room: str) -> dict:
+        # Read the version before the users: anything that changes in between
+        # shows up again in the next delta, which clients apply idempotently.
+        with self._lock:
+            version = self._versions.get(room, 0)
+        return {
+            'room': room,
+            'version': version,
+            'users': self.registry.room_users(room)
+        }
+
+    def flush(self) -> int:
+        """Emit one delta per changed room; returns the number of frames."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            deltas = []
+            for room, changes in pending.items():
+                if not changes:
+                    continue
+                version = self._versions.get(room, 0) + 1
+                self._versions[room] = version
+                deltas.append({
+                    'room': room,
+                    'version': version,
+                    'joined': [u for u, net in changes.items() if net > 0],
+                    'left': [u for u, net in changes.items() if net < 0]
+                })
+        for delta in deltas:
+            self.emit('presence', delta, to=delta['room'])
+        return len(deltas)
@@ -0,0 +1,116 @@
+"""Negotiated wire formats for chat traffic.
+
+Clients pick a protocol in the Socket.IO ``auth`` payload when connecting:
+
+* ``json`` (default): the regular ``message`` / ``messages`` /
+  ``private_message`` events with dict payloads.
+* ``compact``: the same traffic as a single binary ``c`` event whose
+  argument is a msgpack-encoded list. Timestamps are integer epoch
+  milliseconds, room names are replaced by small integer ids and every
+  sender's name appears once per frame.
+
+Compact frames (first element is the kind):
+
+* ``[HELLO, rooms]``: sent on connect; room ids are indexes into ``rooms``
+* ``[MESSAGES, room_id, [username, ...], [[seq, user, ts_ms, msg], ...]]``:
+  room messages, where ``user`` is an index into the frame's username list
+* ``[PRIVATE, from, to, ts_ms, msg]``: a private message
+
+Frames carry no state besides the room list from ``HELLO``, so the server
+keeps nothing per user and a frame dropped for a slow connection (see
+``OutboundLimiter``) costs only the messages in it.
+
+Each audience gets its own delivery room (``wire_room``) so a frame is
+encoded once per protocol and only when somebody speaks that protocol.
+"""
+import threading
+from datetime import datetime
+from typing import Dict, List, Set
+
+import msgpack
+
+PROTOCOLS = ('json', 'compact')
+
+HELLO, MESSAGES, PRIVATE = range(3)
+
+
+def wire_room(room: str, protocol: str) -> str:
+    return f'{room}/{protocol}'
+
+
+def epoch_ms(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+class CompactCodec:
+    """Builds compact frames; room ids are indexes into ``rooms``."""
+
+    def __init__(self, rooms: List[str]):
+        self.rooms = list(rooms)
+        self.room_ids = {room: i for i, room in enumerate(self.rooms)}
+
+    def hello(self) -> bytes:
+        return msgpack.packb([HELLO, self.rooms])
+
+    def messages(self, room: str, messages: List[dict]) -> bytes:
+        users: Dict[str, int] = {}
+        rows = []
+        for message in messages:
+            user = users.setdefault(message['username'], len(users))
+            rows.append([message['seq'], user, epoch_ms(message['timestamp']), message['msg']])
+        return msgpack.packb([MESSAGES, self.room_ids[room], list(users), rows])
+
+    def private(self, payload: dict) -> bytes:
+        return msgpack.packb([PRIVATE, payload['from'], payload['to'],
+                              epoch_ms(payload['timestamp']), payload['msg']])
+
+
+class WireRooms:
+    """Tracks which protocol each local socket speaks, and how many local
+    sockets of each protocol sit in every room, so a frame is only encoded
+    for audiences that exist on this worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._protocols: Dict[str, str] = {}
+        self._rooms: Dict[str, Set[str]] = {}
+        self._counts: Dict[str, int] = {}
+
+    def add(self, sid: str, protocol: str) -> None:
+        with self._lock:
+            self._protocols[sid] = protocol
+            self._rooms[sid] = set()
+
+    def join(self, sid: str, room: str) -> str:
+        """Record ``sid`` in ``room``; returns its delivery room."""
+        with self._lock:
+            key = wire_room(room, self._protocols.get(sid, 'json'))
+            rooms = self._rooms.setdefault(sid, set())
+            if key not in rooms:
+                rooms.add(key)
+                self._counts[key] = self._counts.get(key, 0) + 1
+            return key
+
+    def leave(self, sid: str, room: str) -> str:
+        with self._lock:
+            key = wire_room(room, self._protocols.get(sid, 'json'))
+            if key in self._rooms.get(sid, ()):
+                self._rooms[sid].discard(key)
+                self._release(key)
+            return key
+
+    def remove(self, sid: str) -> None:
+        with self._lock:
+            self._protocols.pop(sid, None)
+            for key in self._rooms.pop(sid, ()):
+                self._release(key)
+
+    def has_members(self, room: str, protocol: str) -> bool:
+        return wire_room(room, protocol) in self._counts
+
+    def _release(self, key: str) -> None:
+        count = self._counts[key] - 1
+        if count:
+            self._counts[key] = count
+        else:
+            del self._counts[key]
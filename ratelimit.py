@@ -0,0 +1,212 @@
+"""Inbound rate limiting and outbound backpressure.
+
+``RateLimiter`` keeps one token bucket per (key, event), where the keys are
+a socket's sid and its username, so several tabs of one user share the
+username budget. Buckets refill lazily when they are checked, which makes
+every check a couple of dict lookups and some arithmetic; ``sweep`` drops
+the ones that have refilled, since a full bucket behaves exactly like a
+missing one. Limits are per worker.
+
+``OutboundLimiter`` watches the engine.io send queue of every connection.
+Once a connection has ``max_queue`` packets waiting (a client that does not
+read fast enough), further messages are dropped or the connection is closed
+so the client reconnects and resumes from room history.
+"""
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_POLICIES = ('drop', 'disconnect')
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated', 'rejected')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.rejected = 0  # rejections since the last allowed event
+
+    def refill(self, rate: float, burst: float, now: float) -> float:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    """Token buckets per event type, applied to each key of a caller."""
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        self.limits = dict(limits)
+        self.rejected: Dict[str, int] = {event: 0 for event in self.limits}
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, TokenBucket]] = {}
+
+    def check(self, event: str, *keys: Optional[str]) -> Optional[float]:
+        """Take a token for ``event`` from every key's bucket.
+
+        Returns None if the event is allowed, otherwise the seconds until it
+        would be. Nothing is taken unless every bucket has a token.
+        """
+        limit = self.limits.get(event)
+        if limit is None:
+            return None
+        rate, burst = limit
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            wait = 0.0
+            for key in keys:
+                if key is None:
+                    continue
+                events = self._buckets.setdefault(key, {})
+                bucket = events.get(event)
+                if bucket is None:
+                    bucket = events[event] = TokenBucket(burst, now)
+                tokens = bucket.refill(rate, burst, now)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate if rate else float('inf'))
+                buckets.append(bucket)
+            if wait:
+                self.rejected[event] += 1
+                for bucket in buckets:
+                    bucket.rejected += 1
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+                bucket.rejected = 0
+            return None
+
+    def first_rejection(self, event: str, key: str) -> bool:
+        """True if the last check of ``key`` started a run of rejections."""
+        bucket = self._buckets.get(key, {}).get(event)
+        return bucket is not None and bucket.rejected == 1
+
+    def forget(self, key: str, only_full: bool = False) -> None:
+        """Drop the buckets of ``key``.
+
+        With ``only_full`` only buckets that have refilled completely are
+        dropped; use it for keys that come back, such as usernames. Keys
+        that never come back, such as sids, must be dropped entirely.
+        """
+        with self._lock:
+            if only_full:
+                self._drop_full(key, time.monotonic())
+            else:
+                self._buckets.pop(key, None)
+
+    def sweep(self) -> int:
+        """Drop every bucket that has refilled completely; returns the number
+        of keys left. Run periodically so idle keys do not pile up."""
+        now = time.monotonic()
+        with self._lock:
+            for key in list(self._buckets):
+                self._drop_full(key, now)
+            return len(self._buckets)
+
+    def _drop_full(self, key: str, now: float) -> None:
+        # Caller holds _lock
+        events = self._buckets.get(key)
+        if events is None:
+            return
+        for event, bucket in list(events.items()):
+            rate, burst = self.limits[event]
+            if bucket.refill(rate, burst, now) >= burst:
+                del events[event]
+        if not events:
+            del self._buckets[key]
+
+    def stats(self) -> dict:
+        return {'rejected': dict(self.rejected), 'tracked_keys': len(self._buckets)}
+
+
+class OutboundLimiter:
+    """Caps the packets queued for each engine.io connection.
+
+    ``install`` wraps the engine.io server's ``send_packet``, which every
+    Socket.IO emit goes through, and checks the connection's queue length
+    before queueing. A Socket.IO packet with binary attachments is sent as
+    several engine.io packets: the header is checked, and its attachments
+    are sent or dropped with it.
+    """
+
+    def __init__(self, max_queue: int, policy: str):
+        if policy not in OUTBOUND_POLICIES:
+            raise ValueError(f"Unknown OUTBOUND_POLICY {policy!r}, expected one of {', '.join(OUTBOUND_POLICIES)}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.dropped = 0
+        self.disconnected = 0
+        # eio sid -> (header admitted, attachments still to come)
+        self._attachments: Dict[str, Tuple[bool, int]] = {}
+        self._closing = set()
+
+    def install(self, eio) -> None:
+        from engineio import packet
+        original = eio.send_packet
+
+        def admit(sid, pkt) -> bool:
+            if pkt.packet_type != packet.MESSAGE:
+                return True
+            pending = self._attachments.get(sid)
+            if pending is not None:
+                admitted, left = pending
+                if left == 1:
+                    del self._attachments[sid]
+                else:
+                    self._attachments[sid] = (admitted, left - 1)
+                return admitted
+            socket = eio.sockets.get(sid)
+            admitted = socket is None or socket.queue.qsize() < self.max_queue
+            attachments = _attachment_count(pkt.data)
+            if attachments:
+                self._attachments[sid] = (admitted, attachments)
+            if admitted:
+                return True
+            self.dropped += 1
+            if self.policy == 'disconnect' and sid not in self._closing:
+                self._closing.add(sid)
+                self.disconnected += 1
+                logger.warning(f"Closing slow connection {sid}: {self.max_queue} packets queued")
+                # Closing fires the disconnect handlers, which must not run
+                # inside whatever emit hit the limit
+                eio.start_background_task(close, socket)
+            return False
+
+        if eio.is_asyncio_based():
+            async def send_packet(sid, pkt):
+                if admit(sid, pkt):
+                    await original(sid, pkt)
+
+            async def close(socket):
+                try:
+                    await socket.close(wait=False, abort=True)
+                finally:
+                    self._closing.discard(socket.sid)
+        else:
+            def send_packet(sid, pkt):
+                if admit(sid, pkt):
+                    original(sid, pkt)
+
+            def close(socket):
+                try:
+                    socket.close(wait=False, abort=True)
+                finally:
+                    self._closing.discard(socket.sid)
+        eio.send_packet = send_packet
+
+    def stats(self) -> dict:
+        return {'dropped': self.dropped, 'disconnected': self.disconnected}
+
+
+def _attachment_count(data) -> int:
+    # Socket.IO binary packets are encoded as '<type><count>-<payload>',
+    # type 5 (binary event) or 6 (binary ack)
+    if isinstance(data, str) and data[:1] in ('5', '6'):
+        dash = data.find('-')
+        if dash > 1:
+            return int(data[1:dash])
+    return 0
@@ -1,13 +1,25 @@
-let socket = io();
+// Room and private messages arrive as msgpack frames; needs static/compact.js
+let socket = io({ transports: ['websocket'], auth: { proto: 'compact' } });
 let currentRoom = 'General';
 let username = document.getElementById('username').textContent;
-let roomMessages = {};
+// Room history lives on the server; we only track cursors
+let historyEpoch = null;
+let lastSeq = 0;
+let historyLoading = false;
+let pendingMessages = [];
 
 /* ----------  SOCKET LISTENERS  ---------- */
 socket.on('connect', () => {
     console.log('Connected to server');
-    joinRoom('General');
-    highlightActiveRoom('General');
+    if (historyEpoch === null) {
+        joinRoom('General');
+        highlightActiveRoom('General');
+        return;
+    }
+    // Reconnected: rejoin and fetch only what we missed
+    historyLoading = true;
+    socket.emit('join', { room: currentRoom });
+    socket.emit('resume', { room: currentRoom, epoch: historyEpoch, last_seq: lastSeq });
 });
 
 socket.on('disconnect', () => {
@@ -18,29 +30,126 @@ socket.on('connect_error', (error) => {
     console.error('Connection error:', error);
 });
 
-socket.on('message', (data) => {
+function addChatMessage(data) {
     addMessage(data.username, data.msg, data.username === username ? 'own' : 'other');
+    lastSeq = Math.max(lastSeq, data.seq);
+}
+
+function flushPendingMessages() {
+    historyLoading = false;
+    pendingMessages.forEach(data => {
+        if (data.seq > lastSeq) addChatMessage(data);
+    });
+    pendingMessages = [];
+}
+
+function handleRoomMessage(data) {
+    if (data.room !== currentRoom) return;
+    if (historyLoading) {
+        pendingMessages.push(data);
+        return;
+    }
+    addChatMessage(data);
+}
+
+socket.on('message', handleRoomMessage);
+
+// Batched delivery: several messages of one room in a single frame
+function handleRoomMessages(batch) {
+    batch.messages.forEach(handleRoomMessage);
+}
+
+socket.on('messages', handleRoomMessages);
+
+socket.on('history', (data) => {
+    if (data.room !== currentRoom) return;
+    historyEpoch = data.epoch;
+    data.messages.forEach(addChatMessage);
+    flushPendingMessages();
 });
 
-socket.on('private_message', (data) => {
+socket.on('resume', (data) => {
+    if (data.room !== currentRoom) return;
+    if (data.truncated) {
+        loadLatestHistory();
+        return;
+    }
+    historyEpoch = data.epoch;
+    data.messages.forEach(addChatMessage);
+    flushPendingMessages();
+});
+
+function handlePrivateMessage(data) {
     addMessage(data.from, `[Private] ${data.msg}`, 'private');
+}
+
+socket.on('private_message', handlePrivateMessage);
+
+CompactProtocol.attach(socket, {
+    messages: handleRoomMessages,
+    private_message: handlePrivateMessage
 });
 
 socket.on('status', (data) => {
     addMessage('System', data.msg, 'system');
 });
 
+socket.on('message_failed', (data) => {
+    addMessage('System', `Your message in ${data.room} could not be delivered, please send it again.`, 'system');
+});
+
+socket.on('rate_limited', (data) => {
+    addMessage('System', `You're doing that too often, try again in ${Math.ceil(data.retry_after)}s.`, 'system');
+});
+
+/* ----------  PRESENCE  ---------- */
+// Users in the current room: username -> list element
+let roomUsers = new Map();
+let presenceVersion = 0;
+
+function addUserItem(user) {
+    if (roomUsers.has(user)) return;
+    const item = document.createElement('div');
+    item.className = 'user-item';
+    item.onclick = () => insertPrivateMessage(user);
+    item.textContent = `${user} ${user === username ? '(you)' : ''}`;
+    roomUsers.set(user, item);
+    document.getElementById('active-users').appendChild(item);
+}
+
+function removeUserItem(user) {
+    const item = roomUsers.get(user);
+    if (!item) return;
+    item.remove();
+    roomUsers.delete(user);
+}
+
+function renderUserList(users) {
+    roomUsers = new Map();
+    document.getElementById('active-users').innerHTML = '';
+    users.forEach(addUserItem);
+}
+
 socket.on('active_users', (data) => {
-    const userList = document.getElementById('active-users');
-    userList.innerHTML = data.users
-        .map(
-            (user) => `
-            <div class="user-item" onclick="insertPrivateMessage('${user}')">
-                ${user} ${user === username ? '(you)' : ''}
-            </div>
-        `
-        )
-        .join('');
+    renderUserList(data.users);
+});
+
+socket.on('presence_snapshot', (data) => {
+    if (data.room !== currentRoom) return;
+    presenceVersion = data.version;
+    renderUserList(data.users);
+});
+
+socket.on('presence', (data) => {
+    if (data.room !== currentRoom || data.version <= presenceVersion) return;
+    if (data.version !== presenceVersion + 1) {
+        // Missed a delta, fetch a fresh snapshot instead
+        socket.emit('presence_sync', { room: currentRoom });
+        return;
+    }
+    presenceVersion = data.version;
+    data.joined.forEach(addUserItem);
+    data.left.forEach(removeUserItem);
 });
 
 /* ----------  HELPERS  ---------- */
@@ -54,9 +163,6 @@ function formatTimestamp() {
 
 /* ----------  NEW BUBBLE RENDERER  ---------- */
 function addMessage(sender, message, type) {
-    if (!roomMessages[currentRoom]) roomMessages[currentRoom] = [];
-    roomMessages[currentRoom].push({ sender, message, type });
-
     const chat = document.getElementById('chat');
     const div = document.createElement('div');
     div.className = `message ${type}`;
@@ -99,12 +205,18 @@ function sendMessage() {
 function joinRoom(room) {
     socket.emit('leave', { room: currentRoom });
     currentRoom = room;
+    presenceVersion = 0;
     socket.emit('join', { room });
     highlightActiveRoom(room);
+    loadLatestHistory();
+}
 
-    const chat = document.getElementById('chat');
-    chat.innerHTML = '';
-    (roomMessages[room] || []).forEach(m => addMessage(m.sender, m.message, m.type));
+function loadLatestHistory() {
+    document.getElementById('chat').innerHTML = '';
+    lastSeq = 0;
+    historyLoading = true;
+    pendingMessages = [];
+    socket.emit('history', { room: currentRoom });
 }
 
 function insertPrivateMessage(user) {
@@ -0,0 +1,111 @@
+/* Compact wire protocol (see protocol.py).
+ *
+ * Connect with `auth: { proto: 'compact' }` and call
+ * `CompactProtocol.attach(socket, handlers)`: room messages and private
+ * messages arrive as msgpack frames on the `c` event and are handed to
+ * `handlers.messages(batch)` and `handlers.private_message(data)` in the same
+ * shape as the JSON events, with `timestamp` as epoch milliseconds.
+ */
+const CompactProtocol = (() => {
+    const HELLO = 0, MESSAGES = 1, PRIVATE = 2;
+    const utf8 = new TextDecoder();
+
+    // Minimal msgpack decoder for the types the server sends
+    function decode(data) {
+        const bytes = data instanceof Uint8Array ? data : new Uint8Array(data);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+
+        function str(length) {
+            const value = utf8.decode(bytes.subarray(pos, pos + length));
+            pos += length;
+            return value;
+        }
+
+        function array(length) {
+            const value = new Array(length);
+            for (let i = 0; i < length; i++) value[i] = read();
+            return value;
+        }
+
+        function map(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+
+        function read() {
+            const type = bytes[pos++];
+            if (type <= 0x7f) return type;
+            if (type <= 0x8f) return map(type & 0x0f);
+            if (type <= 0x9f) return array(type & 0x0f);
+            if (type <= 0xbf) return str(type & 0x1f);
+            if (type >= 0xe0) return type - 0x100;
+            let value;
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: value = bytes.slice(pos + 1, pos + 1 + bytes[pos]); pos += 1 + bytes[pos]; return value;
+                case 0xc5: { const n = view.getUint16(pos); pos += 2; value = bytes.slice(pos, pos + n); pos += n; return value; }
+                case 0xc6: { const n = view.getUint32(pos); pos += 4; value = bytes.slice(pos, pos + n); pos += n; return value; }
+                case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+                case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+                case 0xcc: return bytes[pos++];
+                case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+                case 0xce: value = view.getUint32(pos); pos += 4; return value;
+                case 0xcf: value = view.getUint32(pos) * 0x100000000 + view.getUint32(pos + 4); pos += 8; return value;
+                case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+                case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+                case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+                case 0xd3: value = view.getInt32(pos) * 0x100000000 + view.getUint32(pos + 4); pos += 8; return value;
+                case 0xd9: { const n = bytes[pos]; pos += 1; return str(n); }
+                case 0xda: { const n = view.getUint16(pos); pos += 2; return str(n); }
+                case 0xdb: { const n = view.getUint32(pos); pos += 4; return str(n); }
+                case 0xdc: { const n = view.getUint16(pos); pos += 2; return array(n); }
+                case 0xdd: { const n = view.getUint32(pos); pos += 4; return array(n); }
+                case 0xde: { const n = view.getUint16(pos); pos += 2; return map(n); }
+                case 0xdf: { const n = view.getUint32(pos); pos += 4; return map(n); }
+            }
+            throw new Error(`Unsupported msgpack type 0x${type.toString(16)}`);
+        }
+
+        return read();
+    }
+
+    function attach(socket, handlers) {
+        let rooms = [];
+
+        socket.on('c', (data) => {
+            const frame = decode(data);
+            switch (frame[0]) {
+                case HELLO:
+                    rooms = frame[1];
+                    break;
+                case MESSAGES: {
+                    const room = rooms[frame[1]];
+                    const users = frame[2];
+                    handlers.messages({
+                        room,
+                        messages: frame[3].map(([seq, user, timestamp, msg]) => ({
+                            seq, room, msg, timestamp, username: users[user]
+                        }))
+                    });
+                    break;
+                }
+                case PRIVATE:
+                    handlers.private_message({
+                        from: frame[1], to: frame[2], timestamp: frame[3], msg: frame[4]
+                    });
+                    break;
+            }
+        });
+    }
+
+    return { decode, attach };
+})();
+
+if (typeof module !== 'undefined') module.exports = CompactProtocol;
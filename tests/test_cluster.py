@@ -0,0 +1,299 @@
+"""Cross-worker delivery through the hub.
+
+Starts gunicorn with two workers and the hub, connects one client to each
+worker and checks that room messages, private messages and presence reach
+clients on the other worker. Which worker holds a connection is read from
+/proc, so these tests only run on Linux.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import msgpack
+import pytest
+
+from protocol import MESSAGES, PRIVATE
+
+socketio = pytest.importorskip('socketio')
+pytest.importorskip('gunicorn')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS = 2
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads /proc')
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def children(pid: int):
+    """(pid, cmdline) of every direct child of ``pid``."""
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ').decode()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        if ppid == pid:
+            found.append((int(entry), cmdline))
+    return found
+
+
+class Cluster:
+    def __init__(self):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        env = dict(
+            os.environ,
+            PORT=str(self.port),
+            WEB_CONCURRENCY=str(WORKERS),
+            ASYNC_MODE='eventlet',
+            PRESENCE_COALESCE_MS='50'
+        )
+        env.pop('HUB_SOCKET', None)
+        self.process = subprocess.Popen(
+            # Workers still holding a websocket wait out the graceful timeout
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--graceful-timeout', '3'],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.clients = []
+
+    def workers(self):
+        return [pid for pid, cmdline in children(self.process.pid) if 'hub.py' not in cmdline]
+
+    def hub(self):
+        return [pid for pid, cmdline in children(self.process.pid) if 'hub.py' in cmdline]
+
+    def ready(self) -> bool:
+        try:
+            urllib.request.urlopen(f'{self.url}/health', timeout=1).read()
+        except (OSError, urllib.error.URLError):
+            return False
+        return len(self.workers()) == WORKERS and len(self.hub()) == 1
+
+    def worker_of(self, client) -> int:
+        """Pid of the worker that accepted ``client``'s websocket."""
+        client_port = client.eio.ws.sock.getsockname()[1]
+        local = f':{self.port:04X}'
+        remote = f':{client_port:04X}'
+        inode = None
+        for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+            with open(table) as f:
+                for line in f.readlines()[1:]:
+                    fields = line.split()
+                    if fields[1].endswith(local) and fields[2].endswith(remote):
+                        inode = fields[9]
+        assert inode is not None, 'server side of the websocket not found'
+        target = f'socket:[{inode}]'
+        for pid in self.workers():
+            for fd in os.listdir(f'/proc/{pid}/fd'):
+                try:
+                    if os.readlink(f'/proc/{pid}/fd/{fd}') == target:
+                        return pid
+                except OSError:
+                    continue
+        raise AssertionError('no worker owns the websocket')
+
+    def connect(self, username: str, protocol: str = 'json'):
+        client = socketio.Client()
+        client.username = username
+        client.received = {
+            'message': [], 'private_message': [], 'presence_snapshot': [], 'c': [],
+            'history': [], 'resume': []
+        }
+        for event, received in client.received.items():
+            client.on(event, received.append)
+        client.on('messages', lambda batch: client.received['message'].extend(batch['messages']))
+        client.connect(self.url, transports=['websocket'], auth={'proto': protocol})
+        client.emit('set_username', username)
+        self.clients.append(client)
+        return client
+
+    def connect_on(self, worker: int, username: str):
+        """A client on ``worker``, reconnecting until the kernel picks it."""
+        for attempt in range(50):
+            client = self.connect(username)
+            if self.worker_of(client) == worker:
+                return client
+            client.disconnect()
+            self.clients.remove(client)
+        pytest.skip(f'could not connect to worker {worker}')
+
+    def connect_per_worker(self, protocol: str = 'json'):
+        """One client on every worker; the kernel picks the worker."""
+        by_worker = {}
+        for attempt in range(50):
+            client = self.connect(f'user{attempt}', protocol)
+            worker = self.worker_of(client)
+            if worker in by_worker:
+                client.disconnect()
+                self.clients.remove(client)
+                continue
+            by_worker[worker] = client
+            if len(by_worker) == WORKERS:
+                return list(by_worker.values())
+        pytest.skip('could not spread the clients over every worker')
+
+    def close(self):
+        for client in self.clients:
+            client.disconnect()
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            # The master stops the hub on exit; without it the hub is orphaned
+            for pid in self.hub():
+                os.kill(pid, signal.SIGKILL)
+            self.process.kill()
+
+
+@pytest.fixture
+def cluster():
+    cluster = Cluster()
+    try:
+        assert wait_for(cluster.ready, timeout=30), 'gunicorn did not start'
+        yield cluster
+    finally:
+        cluster.close()
+
+
+def join_general(clients):
+    for client in clients:
+        client.emit('join', {'room': 'General'})
+
+
+def texts(client):
+    return [message['msg'] for message in client.received['message']]
+
+
+def test_room_messages_reach_every_worker(cluster):
+    clients = cluster.connect_per_worker()
+    join_general(clients)
+    time.sleep(0.5)
+    for index, client in enumerate(clients):
+        client.emit('message', {'msg': f'hello from {index}', 'room': 'General'})
+    expected = {f'hello from {index}' for index in range(len(clients))}
+    for client in clients:
+        assert wait_for(lambda: expected <= set(texts(client))), texts(client)
+    # Sequence ids come from the hub, so every worker numbers alike
+    sequences = [[m['seq'] for m in client.received['message']] for client in clients]
+    assert all(seqs == sequences[0] for seqs in sequences)
+
+
+def test_private_messages_cross_workers(cluster):
+    first, second = cluster.connect_per_worker()
+    # The target is looked up in the replicated presence registry
+    time.sleep(0.5)
+    first.emit('message', {'msg': 'ping', 'type': 'private', 'target': second.username})
+    second.emit('message', {'msg': 'pong', 'type': 'private', 'target': first.username})
+    assert wait_for(lambda: [m['msg'] for m in second.received['private_message']] == ['ping'])
+    assert wait_for(lambda: [m['msg'] for m in first.received['private_message']] == ['pong'])
+
+
+def test_resume_on_another_worker(cluster):
+    first, second = cluster.connect_per_worker()
+    for index in range(3):
+        first.emit('message', {'msg': f'm{index}', 'room': 'General'})
+    assert wait_for(lambda: len(second.received['message']) == 3)
+    first.emit('history', {'room': 'General'})
+    assert wait_for(lambda: first.received['history'])
+    page = first.received['history'][0]
+    # A client that reconnects to the other worker keeps its cursor
+    second.emit('resume', {'room': 'General', 'epoch': page['epoch'],
+                           'last_seq': page['messages'][0]['seq']})
+    assert wait_for(lambda: second.received['resume'])
+    resumed = second.received['resume'][0]
+    assert resumed['epoch'] == page['epoch']
+    assert resumed['truncated'] is False
+    assert [m['msg'] for m in resumed['messages']] == ['m1', 'm2']
+
+
+def test_compact_clients_across_workers(cluster):
+    first, second = cluster.connect_per_worker('compact')
+    join_general([first, second])
+    time.sleep(0.5)
+    first.emit('message', {'msg': 'hello', 'room': 'General'})
+    first.emit('message', {'msg': 'ping', 'type': 'private', 'target': second.username})
+
+    def frames(kind):
+        return [frame for frame in map(msgpack.unpackb, second.received['c']) if frame[0] == kind]
+    assert wait_for(lambda: frames(MESSAGES) and frames(PRIVATE))
+    assert frames(MESSAGES)[0][3][0][3] == 'hello'
+    assert frames(PRIVATE)[0][4] == 'ping'
+    # Both sockets stayed registered, so presence lists exactly the two users
+    assert wait_for(lambda: second.received['presence_snapshot']
+                    and set(second.received['presence_snapshot'][-1]['users']) == {first.username, second.username})
+
+
+def test_presence_snapshot_lists_users_of_every_worker(cluster):
+    clients = cluster.connect_per_worker()
+    names = {client.username for client in clients}
+    time.sleep(0.5)
+    join_general(clients)
+    for client in clients:
+        snapshots = client.received['presence_snapshot']
+        assert wait_for(lambda: snapshots and names <= set(snapshots[-1]['users'])), snapshots
+
+
+def test_polling_is_refused(cluster):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f'{cluster.url}/socket.io/?EIO=4&transport=polling', timeout=5)
+    assert error.value.code == 400
+
+
+def test_hub_is_restarted(cluster):
+    first, second = cluster.connect_per_worker()
+    leaving = cluster.connect_on(cluster.worker_of(first), 'leaving')
+    join_general([first, second, leaving])
+    assert wait_for(lambda: 'leaving' in latest_users(second))
+    (hub,) = cluster.hub()
+    os.kill(hub, signal.SIGKILL)
+    # Its removal is published while there is no hub, so it is lost
+    leaving.disconnect()
+    cluster.clients.remove(leaving)
+    assert wait_for(lambda: cluster.hub() not in ([], [hub])), 'hub was not restarted'
+    # Workers reconnect with backoff; messages sent before that are refused
+    for attempt in range(20):
+        first.emit('message', {'msg': f'back {attempt}', 'room': 'General'})
+        if wait_for(lambda: any(text.startswith('back') for text in texts(second)), timeout=0.5):
+            break
+    assert any(text.startswith('back') for text in texts(second))
+
+    # The restarted worker's announcement replaces what the others knew
+    # about its sockets, and the new hub only learns current sockets
+    expected = {first.username, second.username}
+    second.received['presence_snapshot'].clear()
+    second.emit('presence_sync', {'room': 'General'})
+    assert wait_for(lambda: latest_users(second) == expected), latest_users(second)
+    late = cluster.connect('late')
+    late.emit('join', {'room': 'General'})
+    assert wait_for(lambda: latest_users(late) == expected | {'late'}), latest_users(late)
+
+
+def latest_users(client):
+    snapshots = client.received['presence_snapshot']
+    return set(snapshots[-1]['users']) if snapshots else set()
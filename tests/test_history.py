@@ -0,0 +1,83 @@
+from history import RoomHistory, message_size
+
+
+def post(history, count, room='General', text='hi'):
+    return [history.append(room, {'msg': f'{text} {i}', 'username': 'alice'}) for i in range(count)]
+
+
+def seqs(messages):
+    return [message['seq'] for message in messages]
+
+
+def test_page_walks_back_through_retained_messages():
+    history = RoomHistory(max_messages=5, max_bytes=1 << 20)
+    post(history, 10)  # 6..10 are retained
+    assert seqs(history.page('General', limit=2)[0]) == [9, 10]
+    assert history.page('General', limit=2)[1] is True
+    assert seqs(history.page('General', before=9, limit=2)[0]) == [7, 8]
+    messages, has_more = history.page('General', before=8, limit=10)
+    assert (seqs(messages), has_more) == ([6, 7], False)
+
+
+def test_page_before_the_first_retained_message_is_empty():
+    history = RoomHistory(max_messages=5, max_bytes=1 << 20)
+    post(history, 10)
+    assert history.page('General', before=6) == ([], False)
+    assert history.page('General', before=2) == ([], False)
+    assert history.page('General', before=0) == ([], False)
+    assert history.page('Unknown') == ([], False)
+
+
+def test_eviction_by_bytes():
+    one = message_size({'msg': 'hi 0', 'username': 'alice'})
+    history = RoomHistory(max_messages=100, max_bytes=2 * one + one // 2)
+    post(history, 5)
+    assert seqs(history.page('General')[0]) == [4, 5]
+    assert history.stats('General')['bytes'] <= history.max_bytes
+    # The cursor of an evicted message reports the gap
+    assert (seqs(history.since('General', 2)[0]), history.since('General', 2)[1]) == ([4, 5], True)
+    assert history.since('General', 3) == (history.page('General')[0], False)
+
+
+def test_message_bigger_than_max_bytes_is_numbered_but_not_kept():
+    history = RoomHistory(max_messages=100, max_bytes=200)
+    post(history, 2)
+    big = history.append('General', {'msg': 'x' * 500, 'username': 'alice'})
+    assert big['seq'] == 3
+    assert history.stats('General') == {'messages': 0, 'bytes': 0, 'last_seq': 3}
+    assert history.page('General') == ([], False)
+    assert history.since('General', 2) == ([], True)
+    assert history.since('General', 3) == ([], False)
+    assert seqs(post(history, 1)) == [4]
+    assert seqs(history.since('General', 3)[0]) == [4]
+
+
+def test_since_with_a_cursor_ahead_of_the_buffer():
+    history = RoomHistory(max_messages=10, max_bytes=1 << 20)
+    post(history, 3)
+    # A cursor from another buffer; the client must reload
+    assert history.since('General', 7) == ([], True)
+    assert history.since('General', 3) == ([], False)
+    assert history.since('Unknown', 0) == ([], False)
+    assert history.since('Unknown', 2) == ([], True)
+
+
+def test_load_adopts_an_exported_state():
+    source = RoomHistory(max_messages=5, max_bytes=1 << 20)
+    post(source, 8)
+    post(source, 2, room='Hobbies and sports')
+    target = RoomHistory(max_messages=5, max_bytes=1 << 20, epoch='shared')
+    post(target, 1, room='Hobbies and sports', text='ahead')
+    post(target, 2, room='Hobbies and sports', text='ahead')
+    target.load(source.export())
+    # The epoch is given to each process, never taken from a peer's state
+    assert target.epoch == 'shared'
+    assert history_state(target, 'General') == history_state(source, 'General')
+    assert target.stats('General') == source.stats('General')
+    # Rooms that are already at least as far along keep their own messages
+    assert [m['msg'] for m in target.page('Hobbies and sports')[0]][0] == 'ahead 0'
+    assert seqs(post(target, 1)) == [9]
+
+
+def history_state(history, room):
+    return history.page(room, limit=100), history.since(room, 0)
@@ -0,0 +1,28 @@
+import pytest
+
+from presence import PresenceRegistry
+
+
+@pytest.mark.parametrize('username', [{}, None, '', 42])
+def test_rename_rejects_invalid_names_without_changing_state(username):
+    presence = PresenceRegistry()
+    presence.add('sid', 'alice')
+    presence.join('sid', 'General')
+    with pytest.raises(ValueError):
+        presence.rename('sid', username)
+    assert presence.username('sid') == 'alice'
+    assert presence.room_users('General') == ['alice']
+    assert presence.sids_for('alice') == ['sid']
+    presence.remove('sid')
+    assert len(presence) == 0 and presence.usernames() == []
+
+
+def test_rename_moves_the_user_between_indexes():
+    changes = []
+    presence = PresenceRegistry(on_change=lambda *change: changes.append(change))
+    presence.add('sid', 'alice')
+    presence.join('sid', 'General')
+    assert presence.rename('sid', 'bob') == 'alice'
+    assert presence.room_users('General') == ['bob']
+    assert presence.sids_for('alice') == []
+    assert changes[1:] == [('General', 'alice', False), ('General', 'bob', True)]
@@ -0,0 +1,110 @@
+import base64
+import json
+import os
+import shutil
+import subprocess
+
+import msgpack
+import pytest
+
+from protocol import HELLO, MESSAGES, PRIVATE, CompactCodec, WireRooms, epoch_ms
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOMS = ['General', 'Introductions']
+
+
+def message(seq, username, msg, room='General', timestamp='2026-10-16T12:00:00.250000'):
+    return {'seq': seq, 'username': username, 'msg': msg, 'room': room, 'timestamp': timestamp}
+
+
+def decode(frame, rooms=ROOMS):
+    """Python twin of CompactProtocol.attach, returning the JSON-shaped payload."""
+    frame = msgpack.unpackb(frame)
+    if frame[0] == MESSAGES:
+        room = rooms[frame[1]]
+        users = frame[2]
+        return {'room': room, 'messages': [
+            {'seq': seq, 'room': room, 'msg': msg, 'timestamp': ts, 'username': users[user]}
+            for seq, user, ts, msg in frame[3]
+        ]}
+    if frame[0] == PRIVATE:
+        return {'from': frame[1], 'to': frame[2], 'timestamp': frame[3], 'msg': frame[4]}
+    return frame
+
+
+def expected(messages):
+    return [dict(m, timestamp=epoch_ms(m['timestamp'])) for m in messages]
+
+
+def test_hello_lists_the_rooms():
+    assert msgpack.unpackb(CompactCodec(ROOMS).hello()) == [HELLO, ROOMS]
+
+
+def test_messages_round_trip():
+    codec = CompactCodec(ROOMS)
+    batch = [message(1, 'alice', 'hi'), message(2, 'bob', 'hey'), message(3, 'alice', 'ünïcode ✓')]
+    frame = codec.messages('General', batch)
+    assert msgpack.unpackb(frame)[2] == ['alice', 'bob']
+    assert decode(frame) == {'room': 'General', 'messages': expected(batch)}
+
+
+def test_every_frame_defines_its_own_users():
+    codec = CompactCodec(ROOMS)
+    codec.messages('General', [message(1, 'alice', 'first')])
+    # Neither an earlier frame nor another room is needed to decode these
+    later = [message(2, 'bob', 'x'), message(3, 'alice', 'y')]
+    elsewhere = [message(1, 'alice', 'z', room='Introductions')]
+    assert decode(codec.messages('General', later))['messages'] == expected(later)
+    assert decode(codec.messages('Introductions', elsewhere)) == {
+        'room': 'Introductions', 'messages': expected(elsewhere)
+    }
+
+
+def test_private_round_trip():
+    payload = {'from': 'alice', 'to': 'bob', 'msg': 'psst', 'timestamp': '2026-10-16T12:00:00'}
+    assert decode(CompactCodec(ROOMS).private(payload)) == dict(
+        payload, timestamp=epoch_ms(payload['timestamp'])
+    )
+
+
+def test_wire_rooms_count_members_per_protocol():
+    wire = WireRooms()
+    wire.add('a', 'compact')
+    wire.add('b', 'json')
+    assert wire.join('a', 'General') == 'General/compact'
+    wire.join('b', 'General')
+    wire.remove('a')
+    assert not wire.has_members('General', 'compact')
+    assert wire.has_members('General', 'json')
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node')
+def test_javascript_decoder_matches():
+    codec = CompactCodec(ROOMS)
+    # Enough rows and text to need the 16/32-bit msgpack array and string
+    # types, and epoch milliseconds need 64-bit integers
+    batch = [message(70000 + i, f'user{i % 3}', 'x' * (i * 20)) for i in range(20)]
+    batch.append(message(70020, 'ünïcode', 'y' * 70000))
+    payload = {'from': 'alice', 'to': 'bob', 'msg': '✓', 'timestamp': '2026-10-16T12:00:00'}
+    frames = [codec.hello(), codec.messages('Introductions', batch), codec.private(payload)]
+    script = """
+        const CompactProtocol = require(process.argv[1]);
+        const frames = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+        const out = [];
+        const socket = { on: (event, handler) => frames.forEach((f) => handler(Buffer.from(f, 'base64'))) };
+        CompactProtocol.attach(socket, {
+            messages: (batch) => out.push(batch),
+            private_message: (data) => out.push(data),
+        });
+        process.stdout.write(JSON.stringify(out));
+    """
+    result = subprocess.run(
+        ['node', '-e', script, os.path.join(ROOT, 'static', 'compact.js')],
+        input=json.dumps([base64.b64encode(f).decode() for f in frames]),
+        capture_output=True, text=True, check=True
+    )
+    messages, private = json.loads(result.stdout)
+    assert messages == {'room': 'Introductions', 'messages': expected(
+        [dict(m, room='Introductions') for m in batch]
+    )}
+    assert private == dict(payload, timestamp=epoch_ms(payload['timestamp']))
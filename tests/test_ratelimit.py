@@ -0,0 +1,95 @@
+from engineio import packet
+
+from ratelimit import OutboundLimiter, RateLimiter
+
+
+class FakeQueue:
+    def __init__(self):
+        self.size = 0
+
+    def qsize(self):
+        return self.size
+
+
+class FakeSocket:
+    def __init__(self, sid):
+        self.sid = sid
+        self.queue = FakeQueue()
+
+
+class FakeEngineIO:
+    def __init__(self, *sids):
+        self.sockets = {sid: FakeSocket(sid) for sid in sids}
+        self.sent = []
+
+    def send_packet(self, sid, pkt):
+        self.sent.append((sid, pkt.data))
+        self.sockets[sid].queue.size += 1
+
+    def is_asyncio_based(self):
+        return False
+
+    def start_background_task(self, target, *args):
+        pass
+
+
+def binary_event(eio, sid, *attachments):
+    eio.send_packet(sid, packet.Packet(packet.MESSAGE, f'5{len(attachments)}-["c",{{"_placeholder":true,"num":0}}]'))
+    for attachment in attachments:
+        eio.send_packet(sid, packet.Packet(packet.MESSAGE, attachment))
+
+
+def test_attachments_follow_an_admitted_header():
+    eio = FakeEngineIO('a')
+    OutboundLimiter(max_queue=2, policy='drop').install(eio)
+    # The queue reaches the limit after the header, but the attachment that
+    # belongs to it must still go out
+    eio.sockets['a'].queue.size = 1
+    binary_event(eio, 'a', b'frame')
+    assert [data for _, data in eio.sent][1:] == [b'frame']
+
+
+def test_attachments_follow_a_dropped_header():
+    eio = FakeEngineIO('a', 'b')
+    limiter = OutboundLimiter(max_queue=1, policy='drop')
+    limiter.install(eio)
+    eio.sockets['a'].queue.size = 1
+    binary_event(eio, 'a', b'one', b'two')
+    binary_event(eio, 'b', b'three')
+    assert [sid for sid, _ in eio.sent] == ['b', 'b']
+    assert limiter.dropped == 1
+    # Once the queue drains, the next packet is checked afresh
+    eio.sockets['a'].queue.size = 0
+    eio.send_packet('a', packet.Packet(packet.MESSAGE, '2["status",{}]'))
+    assert eio.sent[-1] == ('a', '2["status",{}]')
+
+
+def test_forget_drops_sid_buckets_and_keeps_partial_user_buckets():
+    limiter = RateLimiter({'message': (0.001, 5)})
+    assert limiter.check('message', 'sid', 'user:alice') is None
+    limiter.forget('sid')
+    limiter.forget('user:alice', only_full=True)
+    # The sid is gone although its bucket had not refilled; the user's
+    # partial bucket stays so reconnecting does not reset the budget
+    assert set(limiter._buckets) == {'user:alice'}
+    limiter.check('message', 'user:bob')
+    limiter._buckets['user:bob']['message'].tokens = 5
+    limiter.forget('user:bob', only_full=True)
+    assert 'user:bob' not in limiter._buckets
+
+
+def test_sweep_forgets_keys_once_their_buckets_refill(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('ratelimit.time.monotonic', lambda: now[0])
+    limiter = RateLimiter({'message': (5, 10), 'set_username': (0.2, 3)})
+    for session in range(1000):
+        limiter.check('message', f'sid{session}', f'user:guest{session}')
+        limiter.forget(f'sid{session}')
+        limiter.forget(f'user:guest{session}', only_full=True)
+    limiter.check('set_username', 'user:active')
+    assert limiter.stats()['tracked_keys'] == 1001
+    # The message buckets refill in 0.2s, set_username needs 5s
+    now[0] += 1
+    assert limiter.sweep() == 1
+    now[0] += 5
+    assert limiter.sweep() == 0